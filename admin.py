@@ -1,11 +1,17 @@
 import streamlit as st
 import json
 import datetime as dt
+import time
 from dotenv import load_dotenv
 import os
+import shutil
+
+import database as db
+from tenants import tenant_directory, tenant_keys
 
 load_dotenv()
 admin_password = os.getenv("ADMIN_PASSWORD")
+db.create_db_and_tables()
 
 if "logged_in" not in st.session_state or not st.session_state["logged_in"]:
     st.info("Please log in to access the admin panel.")
@@ -20,194 +26,310 @@ if "logged_in" not in st.session_state or not st.session_state["logged_in"]:
             st.error("Invalid credentials. Please try again.")
 
 
-def steps_page():
+CONTENT_TYPES = [
+    ("text", ":material/text_fields:", "Add text content"),
+    ("photo", ":material/image:", "Add photo content"),
+    ("video", ":material/videocam:", "Add video content"),
+    ("video note", ":material/fiber_manual_record:", "Add video note content"),
+    ("audio", ":material/audiotrack:", "Add audio content"),
+    ("voice", ":material/keyboard_voice:", "Add voice content"),
+    ("document", ":material/description:", "Add document content"),
+]
+STEPS_PER_PAGE = 20
+
+
+def load_saved_script() -> list[dict]:
+    """
+    Load the script from the database. script.json is imported first if the
+    database has no script yet.
+    """
+    path = os.path.join(tenant_directory(db.current_tenant.get()), "script.json")
+    if not db.script_version() and os.path.exists(path):
+        db.import_script_file(path)
+    return db.load_script()[1]
+
+
+def changed_steps(script: list[dict], saved: list[dict]) -> list[int]:
+    """
+    Compare the working copy of the script with the last saved version.
+
+    Returns:
+        list[int]: Indexes of steps that were added or modified. Removed steps
+        are reported by the caller through the length difference.
+    """
+    return [
+        i for i, step in enumerate(script) if i >= len(saved) or step != saved[i]
+    ]
+
+
+def step_editor(script: list[dict], i: int):
+    """
+    Render widgets for a single step. Only the step being edited is rendered,
+    so rerun cost does not depend on the number of steps in the script.
+    """
+    step = script[i]
 
     def changed():
         st.session_state["changed"] = True
+        st.session_state["dirty_steps"].add(i)
 
-    def remove_content(script, step_index, content_index):
-        script[step_index]["content"].pop(content_index)
-        changed()
+    def clear_content_widgets():
+        # Content widgets are keyed by position, drop their state after the
+        # positions shift so values don't move to the neighbouring item.
+        for key in list(st.session_state.keys()):
+            if isinstance(key, str) and key.startswith(f"step_{i}_content_"):
+                del st.session_state[key]
 
-    if "script" not in st.session_state:
-        with open("script.json", "r", encoding="utf-8") as f:
-            st.session_state["script"] = json.load(f)
-    script = st.session_state["script"]
-    st.title("Manage Steps")
+    def remove_content(content_index: int):
+        step["content"].pop(content_index)
+        clear_content_widgets()
+        changed()
 
-    for i, step in enumerate(script):
-        with st.expander(f"Step {i}: {step['title']}") as ex:
-            step["title"] = st.text_input(
-                f"Title",
-                value=step["title"],
-                key=f"title_{i}",
-                on_change=changed,
-            )
-            step["description"] = st.text_area(
-                f"Description",
-                value=step["description"],
-                key=f"description_{i}",
-                on_change=changed,
+    def add_content(content_type: str):
+        if content_type == "text":
+            step["content"].append({"type": "text", "value": ""})
+        else:
+            step["content"].append(
+                {"type": content_type, "file_id": "", "path": "", "caption": ""}
             )
+        changed()
 
-            for j, content in enumerate(step["content"]):
-                with st.container(border=True):
-                    content_type = content.get("type", None)
-
-                    c1, c2 = st.columns([10, 1])
-                    with c1:
-                        st.text(content_type)
-                    with c2:
-                        st.button(
-                            "",
-                            key=f"remove_step_{i}_content_{j}",
-                            on_click=remove_content,
-                            args=(script, i, j),
-                            icon=":material/delete:",
-                            help="Remove this content item",
-                            width="stretch",
-                        )
-                    if content_type == "text":
-                        content["value"] = st.text_area(
-                            f"Text",
-                            value=content["value"],
-                            key=f"step_{i}_content_{j}_text",
-                            on_change=changed,
-                        )
-                    else:
-                        content["file_id"] = st.text_input(
-                            f"File ID",
-                            value=content["file_id"],
-                            key=f"step_{i}_content_{j}_photo_file_id",
-                            on_change=changed,
-                        )
-                        content["caption"] = st.text_input(
-                            f"Caption",
-                            value=content["caption"],
-                            key=f"step_{i}_content_{j}_photo_caption",
-                            on_change=changed,
-                        )
+    def remove_step():
+        script.pop(i)
+        for key in list(st.session_state.keys()):
+            if isinstance(key, str) and key.startswith(f"step_{i}_"):
+                del st.session_state[key]
+        st.session_state["dirty_steps"] = {
+            j if j < i else j - 1 for j in st.session_state["dirty_steps"] if j != i
+        }
+        st.session_state["edit_step"] = None
+        st.session_state["changed"] = True
 
-            c1, c2 = st.columns([9, 1])
+    st.subheader(f"Step {i}: {step['title']}")
+    step["title"] = st.text_input(
+        "Title",
+        value=step["title"],
+        key=f"step_{i}_title",
+        on_change=changed,
+    )
+    step["description"] = st.text_area(
+        "Description",
+        value=step["description"],
+        key=f"step_{i}_description",
+        on_change=changed,
+    )
+
+    for j, content in enumerate(step["content"]):
+        with st.container(border=True):
+            content_type = content.get("type", None)
+
+            c1, c2 = st.columns([10, 1])
             with c1:
-                with st.container(horizontal=True):
-                    if st.button(
-                        "",
-                        key=f"add_text_step_{i}",
-                        icon=":material/text_fields:",
-                        help="Add text content",
-                    ):
-                        step["content"].append({"type": "text", "value": ""})
-                        changed()
-                        st.rerun()
-
-                    if st.button(
-                        "",
-                        key=f"add_photo_step_{i}",
-                        icon=":material/image:",
-                        help="Add photo content",
-                    ):
-                        step["content"].append(
-                            {"type": "photo", "file_id": "", "caption": ""}
-                        )
-                        changed()
-                        st.rerun()
-
-                    if st.button(
-                        "",
-                        key=f"add_video_step_{i}",
-                        icon=":material/videocam:",
-                        help="Add video content",
-                    ):
-                        step["content"].append(
-                            {"type": "video", "file_id": "", "caption": ""}
-                        )
-                        changed()
-                        st.rerun()
-
-                    if st.button(
-                        "",
-                        key=f"add_video_note_step_{i}",
-                        icon=":material/fiber_manual_record:",
-                        help="Add video note content",
-                    ):
-                        step["content"].append(
-                            {"type": "video note", "file_id": "", "caption": ""}
-                        )
-                        changed()
-                        st.rerun()
-
-                    if st.button(
-                        "",
-                        key=f"add_audio_step_{i}",
-                        icon=":material/audiotrack:",
-                        help="Add audio content",
-                    ):
-                        step["content"].append(
-                            {"type": "audio", "file_id": "", "caption": ""}
-                        )
-                        changed()
-                        st.rerun()
-
-                    if st.button(
-                        "",
-                        key=f"add_voice_step_{i}",
-                        icon=":material/keyboard_voice:",
-                        help="Add voice content",
-                    ):
-                        step["content"].append(
-                            {"type": "voice", "file_id": "", "caption": ""}
-                        )
-                        changed()
-                        st.rerun()
-
-                    if st.button(
-                        "",
-                        key=f"add_document_step_{i}",
-                        icon=":material/description:",
-                        help="Add document content",
-                    ):
-                        step["content"].append(
-                            {"type": "document", "file_id": "", "caption": ""}
-                        )
-                        changed()
-                        st.rerun()
+                st.text(content_type)
             with c2:
-                if st.button(
+                st.button(
                     "",
-                    key=f"remove_step_{i}",
+                    key=f"step_{i}_content_{j}_remove",
+                    on_click=remove_content,
+                    args=(j,),
                     icon=":material/delete:",
-                    help="Remove this step",
+                    help="Remove this content item",
                     width="stretch",
-                    type="primary",
-                ):
-                    script.pop(i)
-                    changed()
-                    st.rerun()
+                )
+            if content_type == "text":
+                content["value"] = st.text_area(
+                    "Text",
+                    value=content["value"],
+                    key=f"step_{i}_content_{j}_text",
+                    on_change=changed,
+                )
+            else:
+                content["file_id"] = st.text_input(
+                    "File ID",
+                    value=content["file_id"],
+                    key=f"step_{i}_content_{j}_file_id",
+                    on_change=changed,
+                )
+                content["path"] = st.text_input(
+                    "Local path",
+                    value=content.get("path", ""),
+                    key=f"step_{i}_content_{j}_path",
+                    on_change=changed,
+                    help="Used when File ID is empty. The bot uploads the file "
+                    "once and reuses its file_id for later sends.",
+                )
+                content["caption"] = st.text_input(
+                    "Caption",
+                    value=content["caption"],
+                    key=f"step_{i}_content_{j}_caption",
+                    on_change=changed,
+                )
+
+    c1, c2 = st.columns([9, 1])
+    with c1:
+        with st.container(horizontal=True):
+            for content_type, icon, help in CONTENT_TYPES:
+                st.button(
+                    "",
+                    key=f"step_{i}_add_{content_type}",
+                    on_click=add_content,
+                    args=(content_type,),
+                    icon=icon,
+                    help=help,
+                )
+    with c2:
+        st.button(
+            "",
+            key=f"step_{i}_remove",
+            on_click=remove_step,
+            icon=":material/delete:",
+            help="Remove this step",
+            width="stretch",
+            type="primary",
+        )
+
+
+def steps_page():
+
+    if "script" not in st.session_state:
+        saved = load_saved_script()
+        st.session_state["saved_script"] = saved
+        st.session_state["script"] = json.loads(json.dumps(saved))
+        st.session_state["dirty_steps"] = set()
+        st.session_state["edit_step"] = None
+    script = st.session_state["script"]
+    dirty_steps = st.session_state["dirty_steps"]
+    st.title("Manage Steps")
+
+    query = st.text_input("Search steps", placeholder="Title or description")
+    if query:
+        q = query.lower()
+        found = [
+            i
+            for i, step in enumerate(script)
+            if q in step["title"].lower() or q in step["description"].lower()
+        ]
+    else:
+        found = list(range(len(script)))
+
+    page_count = max(1, (len(found) + STEPS_PER_PAGE - 1) // STEPS_PER_PAGE)
+    page = st.number_input(
+        f"Page (of {page_count})",
+        min_value=1,
+        max_value=page_count,
+        value=1,
+        step=1,
+    )
+    first = (page - 1) * STEPS_PER_PAGE
+    with st.container(border=True):
+        if not found:
+            st.caption("No steps found")
+        for i in found[first : first + STEPS_PER_PAGE]:
+            label = f"Step {i}: {script[i]['title']}"
+            if i in dirty_steps:
+                label += " *"
+            if st.button(
+                label,
+                key=f"open_step_{i}",
+                type="primary" if st.session_state["edit_step"] == i else "tertiary",
+            ):
+                st.session_state["edit_step"] = i
+                st.rerun()
+
+    edit_step = st.session_state["edit_step"]
+    if edit_step is not None and edit_step < len(script):
+        with st.container(border=True):
+            step_editor(script, edit_step)
+
     with st.container(horizontal=True):
 
         if "changed" in st.session_state and st.session_state["changed"]:
             if st.button("Save All", type="primary"):
-                with open("script.json", "w", encoding="utf-8") as f:
-                    json.dump(script, f, indent=4, ensure_ascii=False)
+                saved = st.session_state["saved_script"]
+                diff = changed_steps(script, saved)
+                removed = max(0, len(saved) - len(script))
+                if diff or removed:
+                    db.save_script(script, diff)
+                    st.session_state["saved_script"] = json.loads(json.dumps(script))
+                st.session_state["dirty_steps"] = set()
                 st.session_state["changed"] = False
-                st.success("Changes saved successfully!")
+                st.success(
+                    f"Saved {len(diff)} changed and {removed} removed steps."
+                )
                 st.rerun()
 
         if st.button("Add New Step", type="secondary"):
             script.append({"title": "New Step", "description": "", "content": []})
+            st.session_state["dirty_steps"].add(len(script) - 1)
+            st.session_state["edit_step"] = len(script) - 1
             st.session_state["changed"] = True
             st.rerun()
 
 
+def settings_path() -> str:
+    """
+    Get the path of settings.json of the selected tenant, the file is
+    copied from default_settings.json if missing.
+    """
+    directory = tenant_directory(db.current_tenant.get())
+    path = os.path.join(directory, "settings.json")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        shutil.copy("default_settings.json", path)
+    return path
+
+
+def settings_file_version() -> tuple[int, int]:
+    """
+    Get a cheap version marker of settings.json.
+
+    Returns:
+        tuple[int, int]: Modification time in nanoseconds and file size.
+    """
+    stat = os.stat(settings_path())
+    return stat.st_mtime_ns, stat.st_size
+
+
+@st.cache_data(max_entries=16)
+def load_settings_file(path: str, version: tuple[int, int]) -> dict:
+    """
+    Load a settings.json once per file version. The cache is shared between
+    sessions, each call returns its own copy of the data. Keys missing in
+    the file are filled from default_settings.json.
+    """
+    with open("default_settings.json", "r", encoding="utf-8") as f:
+        defaults = json.load(f)
+    with open(path, "r", encoding="utf-8") as f:
+        settings = json.load(f)
+    for key, value in defaults.items():
+        settings.setdefault(key, value)
+    for key, value in defaults["messages"].items():
+        settings["messages"].setdefault(key, value)
+    return settings
+
+
+def save_settings_file(settings: dict):
+    with open(settings_path(), "w", encoding="utf-8") as f:
+        json.dump(settings, f, indent=4, ensure_ascii=False)
+    load_settings_file.clear()
+    version = settings_file_version()
+    st.session_state["settings"] = load_settings_file(settings_path(), version)
+    st.session_state["settings_version"] = version
+    st.session_state["settings_changed"] = False
+
+
 def setings_page():
 
     def settings_changed():
         st.session_state["settings_changed"] = True
 
-    if True:  # "settings" not in st.session_state:
-        with open("settings.json", "r", encoding="utf-8") as f:
-            st.session_state["settings"] = json.load(f)
+    version = settings_file_version()
+    if "settings" not in st.session_state or (
+        st.session_state["settings_version"] != version
+        and not st.session_state.get("settings_changed", False)
+    ):
+        st.session_state["settings"] = load_settings_file(settings_path(), version)
+        st.session_state["settings_version"] = version
     settings = st.session_state["settings"]
 
     st.title("Settings")
@@ -218,6 +340,31 @@ def setings_page():
             settings["create_paid_users"],
             on_change=settings_changed,
         )
+        settings["reconcile_payments"] = st.toggle(
+            "Check payments with bulk list queries",
+            settings["reconcile_payments"],
+            on_change=settings_changed,
+            help="When off, each pending payment is checked with its own request.",
+        )
+    with st.container(border=True):
+        st.text("Payment Settings")
+        settings["payment"]["amount"] = st.text_input(
+            "Price, RUB",
+            settings["payment"]["amount"],
+            on_change=settings_changed,
+            help="Amount with kopecks, e.g. 4800.00",
+        )
+        settings["payment"]["description"] = st.text_input(
+            "Payment description",
+            settings["payment"]["description"],
+            on_change=settings_changed,
+        )
+        settings["payment"]["return_url"] = st.text_input(
+            "Return link after payment",
+            settings["payment"]["return_url"],
+            on_change=settings_changed,
+            help="Leave empty to send the buyer back to this bot.",
+        )
     with st.container(border=True):
         st.text("Notifications Settings")
         settings["next_step_delay"]["type"] = st.selectbox(
@@ -229,7 +376,7 @@ def setings_page():
         if settings["next_step_delay"]["type"] == "Period":
             label = "Next Step Delay HH:MM"
         else:
-            label = "Next Step Delivery Time HH:MM"
+            label = "Next Step Delivery Time HH:MM (user's local time)"
         value = settings["next_step_delay"]["value"]
         h = value // 3600
         m = (value % 3600) // 60
@@ -258,23 +405,219 @@ def setings_page():
 
             if key == "next_step_timeout":
                 st.caption(
-                    "Where {time} will be replaced with time in \"HH:MM МСК\" format"
+                    "Where {time} will be replaced with time in \"HH:MM МСК\" format, "
+                    "or \"HH:MM UTC+5\" for users who set another time zone"
                 )
 
+            if key == "timezone_set":
+                st.caption("Where {timezone} will be replaced with \"МСК\" or \"UTC+5\"")
+
     if "settings_changed" in st.session_state and st.session_state["settings_changed"]:
-        if st.button("Save Settings", type="primary"):
-            with open("settings.json", "w", encoding="utf-8") as f:
-                json.dump(settings, f, indent=4, ensure_ascii=False)
-            st.session_state["settings"] = settings
-            st.session_state["settings_changed"] = False
+        if st.session_state["settings_version"] != version:
+            st.warning(
+                "settings.json was changed on disk after you started editing. "
+                "Saving will overwrite those changes."
+            )
+            with st.container(horizontal=True):
+                if st.button("Overwrite", type="primary"):
+                    save_settings_file(settings)
+                    st.rerun()
+                if st.button("Discard my changes"):
+                    load_settings_file.clear()
+                    del st.session_state["settings"]
+                    st.session_state["settings_changed"] = False
+                    st.rerun()
+        elif st.button("Save Settings", type="primary"):
+            save_settings_file(settings)
             st.rerun()
 
 
+@st.cache_data(ttl=30)
+def load_analytics(tenant: str, script_length: int) -> dict:
+    """
+    Run the aggregate queries for the analytics page of a tenant. Results
+    are shared between sessions and refreshed at most every 30 seconds.
+    """
+    db.current_tenant.set(tenant)
+    return {
+        "steps": db.users_per_step(),
+        "payments": db.payment_status_counts(),
+        "lag": db.invite_lag_distribution(time.time(), script_length),
+        "archived": db.archived_users_count(),
+        "updated": time.time(),
+    }
+
+
+def analytics_page():
+    st.title("Analytics")
+    if not db.script_version():
+        load_saved_script()  # imports script.json on first use
+    script_length = db.script_length()
+    data = load_analytics(db.current_tenant.get(), script_length)
+
+    total = sum(count for _, count in data["steps"])
+    completed = sum(count for step, count in data["steps"] if step >= script_length)
+    paid = sum(count for _, payed, count in data["payments"] if payed)
+    pending = sum(
+        count
+        for status, payed, count in data["payments"]
+        if status == "pending" and not payed
+    )
+
+    with st.container(horizontal=True):
+        st.metric("Users", total)
+        st.metric("Paid", paid)
+        st.metric("Pending payment", pending)
+        st.metric(
+            "Completed",
+            completed,
+            help=f"{completed / paid:.0%} of paid users" if paid else None,
+        )
+        st.metric(
+            "Archived",
+            data["archived"],
+            help="Idle users moved out of the main table, not counted above",
+        )
+
+    with st.container(border=True):
+        st.text("Users per step")
+        st.bar_chart(
+            {
+                "step": [step for step, _ in data["steps"]],
+                "users": [count for _, count in data["steps"]],
+            },
+            x="step",
+            y="users",
+        )
+
+    with st.container(border=True):
+        st.text("Payment status")
+        st.dataframe(
+            [
+                {"status": status or "none", "payed": payed, "users": count}
+                for status, payed, count in data["payments"]
+            ],
+            hide_index=True,
+        )
+
+    with st.container(border=True):
+        st.text("Waiting for next step invite, hours since last step")
+        st.bar_chart(
+            {
+                "hours": [hours for hours, _ in data["lag"]],
+                "users": [count for _, count in data["lag"]],
+            },
+            x="hours",
+            y="users",
+        )
+
+    updated = dt.datetime.fromtimestamp(data["updated"]).strftime("%H:%M:%S")
+    st.caption(f"Updated at {updated}")
+    if st.button("Refresh"):
+        load_analytics.clear()
+        st.rerun()
+
+
+def broadcasts_page():
+    st.title("Broadcasts")
+
+    with st.form("new_broadcast", clear_on_submit=True):
+        text = st.text_area("Message")
+        target = st.radio(
+            "Recipients",
+            ["All users", "Paid users", "Users on step"],
+            horizontal=True,
+        )
+        step = st.number_input(
+            "Step",
+            min_value=1,
+            value=1,
+            step=1,
+            help="Used with 'Users on step': users whose next step is this one",
+        )
+        if st.form_submit_button("Send", type="primary"):
+            if not text.strip():
+                st.error("Message is empty.")
+            else:
+                broadcast = db.create_broadcast(
+                    text,
+                    paid_only=target == "Paid users",
+                    step=int(step) if target == "Users on step" else None,
+                )
+                st.success(
+                    f"Broadcast {broadcast.id} queued for {broadcast.total} users."
+                )
+
+    if st.button("Refresh", icon=":material/refresh:"):
+        st.rerun()
+    for broadcast in db.recent_broadcasts():
+        with st.container(border=True):
+            done = broadcast.sent + broadcast.failed
+            c1, c2 = st.columns([9, 1])
+            with c1:
+                st.text(f"#{broadcast.id} {broadcast.status}: {broadcast.text[:80]}")
+            with c2:
+                if broadcast.status in ("pending", "running"):
+                    st.button(
+                        "",
+                        key=f"cancel_broadcast_{broadcast.id}",
+                        on_click=db.cancel_broadcast,
+                        args=(broadcast.id,),
+                        icon=":material/cancel:",
+                        help="Cancel this broadcast",
+                        width="stretch",
+                    )
+            st.progress(
+                min(1.0, done / broadcast.total) if broadcast.total else 1.0,
+                text=f"{done} of {broadcast.total}, {broadcast.failed} failed",
+            )
+            if broadcast.started_time:
+                end = broadcast.finished_time or time.time()
+                elapsed = max(end - broadcast.started_time, 1)
+                st.caption(f"{done / elapsed:.1f} messages per second")
+
+
+def select_tenant():
+    """
+    Choose the tenant whose script, settings and users the pages edit. The
+    editing state of the previously selected tenant is dropped.
+    """
+    names = list(tenant_keys()) or [""]
+    tenant = names[0]
+    if len(names) > 1:
+        tenant = st.sidebar.selectbox(
+            "Course", names, format_func=lambda name: name or "default"
+        )
+    if st.session_state.get("tenant", tenant) != tenant:
+        for key in list(st.session_state.keys()):
+            if key in TENANT_STATE or (
+                isinstance(key, str) and key.startswith("step_")
+            ):
+                del st.session_state[key]
+    st.session_state["tenant"] = tenant
+    db.current_tenant.set(tenant)
+
+
+TENANT_STATE = (
+    "script",
+    "saved_script",
+    "dirty_steps",
+    "edit_step",
+    "changed",
+    "settings",
+    "settings_version",
+    "settings_changed",
+)
+
+
 if "logged_in" in st.session_state and st.session_state["logged_in"]:
+    select_tenant()
     page = st.navigation(
         [
             st.Page(steps_page, title="Manage Steps"),
             st.Page(setings_page, title="Settings"),
+            st.Page(analytics_page, title="Analytics"),
+            st.Page(broadcasts_page, title="Broadcasts"),
         ],
         position="top",
     )
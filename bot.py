@@ -1,15 +1,20 @@
 import os
-from typing import Any
-from sqlmodel import SQLModel, create_engine, Field, Session, select
-from sqlalchemy import BigInteger, exc
+import time as timer
+
+_started: float | None = timer.perf_counter()
+
+from typing import Any, Iterator
+from sqlmodel import Session, and_, or_
 from dotenv import load_dotenv
 from os import getenv
 import json
 import asyncio
+import re
 import shutil
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command, CommandStart
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import (
     Message,
     InlineKeyboardMarkup,
@@ -19,10 +24,51 @@ from aiogram.types import (
 )
 
 import logging
-from kassa import create_payment, get_payment_status
+from kassa import (
+    PAYMENT_LIFETIME,
+    KassaUnavailable,
+    create_payment,
+    get_payment_created_time,
+    get_payment_status,
+    payments_available,
+    reconcile_payments,
+)
+from database import (
+    DEFAULT_UTC_OFFSET,
+    Broadcast,
+    User,
+    engine,
+    archive_users,
+    broadcast_criteria,
+    broadcast_status,
+    create_broadcast,
+    current_tenant,
+    create_db_and_tables,
+    get_user,
+    import_script_file,
+    iter_user_chunks,
+    load_script,
+    next_broadcast,
+    expire_payments,
+    oldest_pending_payment,
+    save_script,
+    set_users,
+    script_version,
+    set_broadcast,
+    settle_payments,
+    unarchive_unfinished,
+    utc_offsets,
+)
+from writer import WriteQueue
 
 import bot_messages as bms
-from datetime import datetime, timezone, timedelta, time
+import health
+import lanes
+import media
+from health import HealthServer
+from tenants import tenant_directory, tenant_keys
+from throttling import ThrottlingMiddleware
+from datetime import date, datetime, timezone, timedelta, time
 
 logging.basicConfig(
     filename="bot.log",
@@ -32,57 +78,196 @@ logging.basicConfig(
 logger = logging.getLogger("bot")
 
 
-class User(SQLModel, table=True):
-    id: int = Field(primary_key=True, sa_type=BigInteger)
-    current_step: int = Field(default=0)
-    payment_status: str = Field(default="")
-    payment_key: str = Field(default="")
-    payed: bool = Field(default=False)
-    step_sent_time: float = Field(default=0.0)
-    next_step_invite_sent: bool = Field(default=False)
-    upload_mode: bool = Field(default=False)
-    is_admin: bool = Field(default=False)
+load_dotenv()
+bot_keys = tenant_keys()
 
+if not bot_keys:
+    raise ValueError("BOT_KEY environment variable not set")
 
-load_dotenv()
-db_url = getenv("DB_URL")
-bot_key = getenv("BOT_KEY")
+SCRIPT_CHECK_INTERVAL = 1
 
-if db_url is None:
-    raise ValueError("DB_URL environment variable not set")
 
-if bot_key is None:
-    raise ValueError("BOT_KEY environment variable not set")
+def load_settings(directory: str = ".") -> dict[str, Any]:
+    """
+    Load settings.json from the directory of a tenant, it is copied from
+    default_settings.json if missing. Keys missing in settings files created
+    by older versions are taken from default_settings.json.
+
+    Returns:
+        dict[str, Any]: Bot settings.
+    """
+    path = os.path.join(directory, "settings.json")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        shutil.copy("default_settings.json", path)
+        logger.info(f"{path} not found, copied default_settings.json to {path}")
+    defaults = json.load(open("default_settings.json", "r", encoding="utf-8"))
+    settings = json.load(open(path, "r", encoding="utf-8"))
+    for key, value in defaults.items():
+        settings.setdefault(key, value)
+    for key, value in defaults["messages"].items():
+        settings["messages"].setdefault(key, value)
+    return settings
+
+
+class Tenant:
+    """
+    A bot served by this process with its settings and script. Bot API rate
+    limits are per token, so each bot gets its own limiter.
+    """
+
+    def __init__(self, name: str, bot_key: str):
+        self.name = name
+        self.directory = tenant_directory(name)
+        self.bot = Bot(token=bot_key)
+        self.limiter = lanes.limiter if not name else lanes.PriorityLimiter()
+        self.bot.session.middleware(lanes.LaneMiddleware(self.limiter))
+        self.settings = load_settings(self.directory)
+        # compiled script, its version and when the version was last checked
+        self.script: list[dict] | None = None
+        self.script_version = 0
+        self.script_checked = 0.0
 
-engine = create_engine(db_url)
+    async def payment_return_url(self) -> str:
+        """
+        Get the link a buyer is sent to after paying: return_url from the
+        payment settings, BOT_LINK for the default bot, otherwise the bot's
+        own t.me link.
+        """
+        url = self.settings["payment"]["return_url"]
+        if not url and not self.name:
+            url = getenv("BOT_LINK", "")
+        if not url:
+            url = f"https://t.me/{(await self.bot.me()).username}"
+        return url
 
-try:
-    script: list[dict] = json.load(open("script.json", "r", encoding="utf-8"))
-except FileNotFoundError:
-    shutil.copy("test_script.json", "script.json")
-    logger.info("script.json not found, copied test_script.json to script.json")
-    script: list[dict] = json.load(open("script.json", "r", encoding="utf-8"))
+    def get_script(self) -> list[dict]:
+        """
+        Get the course script stored in the database. The script is loaded on
+        first use and again only after its version changes, the version is
+        checked at most once per SCRIPT_CHECK_INTERVAL seconds. On the first
+        start script.json (or test_script.json) is imported into the database.
+
+        Returns:
+            list[dict]: Steps of the script.
+        """
+        if self.script is not None and timer.monotonic() - self.script_checked < SCRIPT_CHECK_INTERVAL:
+            return self.script
+        token = current_tenant.set(self.name)
+        try:
+            version = script_version()
+            if not version:
+                path = os.path.join(self.directory, "script.json")
+                if not os.path.exists(path):
+                    shutil.copy("test_script.json", path)
+                    logger.info(f"{path} not found, copied test_script.json to {path}")
+                version = import_script_file(path)
+                logger.info(bms.script_imported.format(path=path, version=version))
+            if self.script is None or version != self.script_version:
+                self.script_version, self.script = load_script()
+        finally:
+            current_tenant.reset(token)
+        self.script_checked = timer.monotonic()
+        return self.script
+
+
+tenants = {name: Tenant(name, key) for name, key in bot_keys.items()}
+_tenants_by_bot_id = {t.bot.id: t for t in tenants.values()}
+
+
+def tenant() -> Tenant:
+    """Get the tenant of the update or background job being processed."""
+    return tenants[current_tenant.get()]
+
+
+def each_tenant() -> Iterator[Tenant]:
+    """Make each tenant current in turn, used by background tasks that
+    serve all tenants."""
+    for t in list(tenants.values()):
+        current_tenant.set(t.name)
+        yield t
+
+
+def get_script() -> list[dict]:
+    return tenant().get_script()
+
+
+async def tenant_middleware(handler, event, data):
+    """Make the tenant of the bot that received the update current."""
+    token = current_tenant.set(_tenants_by_bot_id[data["bot"].id].name)
+    try:
+        return await handler(event, data)
+    finally:
+        current_tenant.reset(token)
 
-try:    
-    settings: dict[str, Any] = json.load(open("settings.json", "r", encoding="utf-8"))
-except FileNotFoundError:
-    shutil.copy("default_settings.json", "settings.json")
-    settings: dict[str, Any] = json.load(open("settings.json", "r", encoding="utf-8"))
-    logger.info("settings.json not found, copied default_settings.json to settings.json")
 
-bot = Bot(token=bot_key)
 dp = Dispatcher()
+dp.update.outer_middleware(tenant_middleware)
+throttling = ThrottlingMiddleware()
+dp.update.outer_middleware(throttling)
+writer = WriteQueue(engine)
+# set when the bot is stopping, background tasks finish their current
+# work and exit
+shutdown = asyncio.Event()
+SHUTDOWN_TIMEOUT = 30
+
+
+async def pause(seconds: float):
+    """
+    Sleep between iterations of a background task. Returns early when
+    shutdown starts.
+    """
+    try:
+        await asyncio.wait_for(shutdown.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
 
 
 def now() -> float:
     """
-    Get the current time in UTC+3 timezone as a timestamp.
+    Get the current time as a timestamp.
 
     Returns:
-        float: Current time in UTC+3 as a Unix timestamp.
+        float: Current time as a Unix timestamp.
+    """
+    return datetime.now(timezone.utc).timestamp()
+
+
+def user_timezone(utc_offset: int) -> timezone:
+    """
+    Get a timezone from a user's UTC offset in minutes.
+    """
+    return timezone(timedelta(minutes=utc_offset))
+
+
+def format_utc_offset(utc_offset: int) -> str:
+    """
+    Format a UTC offset in minutes for messages, e.g. "UTC+5" or "UTC-3:30".
+    Moscow time (UTC+3) is shown as "МСК".
     """
-    utc_plus_3 = timezone(timedelta(hours=3))
-    return datetime.now(utc_plus_3).timestamp()
+    if utc_offset == DEFAULT_UTC_OFFSET:
+        return "МСК"
+    sign = "+" if utc_offset >= 0 else "-"
+    hh, mm = divmod(abs(utc_offset), 60)
+    return f"UTC{sign}{hh}" + (f":{mm:02}" if mm else "")
+
+
+def parse_utc_offset(text: str) -> int | None:
+    """
+    Parse a UTC offset like "+5", "-3:30" or "5" into minutes.
+
+    Returns:
+        int | None: Offset in minutes or None if the text is not a valid offset.
+    """
+    match = re.fullmatch(r"(UTC)?\s*([+-]?)(\d{1,2})(?::(\d{2}))?", text.strip(), re.I)
+    if not match:
+        return None
+    minutes = int(match.group(3)) * 60 + int(match.group(4) or 0)
+    if match.group(2) == "-":
+        minutes = -minutes
+    if not -12 * 60 <= minutes <= 14 * 60 or minutes % 15:
+        return None
+    return minutes
 
 
 @dp.message(CommandStart())
@@ -90,51 +275,143 @@ async def start_command_handler(message: Message):
     if message.from_user:
         logger.info(bms.on_start_command.format(id=message.from_user.id))
         with Session(engine) as session:
-            user = session.get(User, message.from_user.id)
+            user = get_user(session, message.from_user.id)
             if not user:
                 user = User(id=message.from_user.id)
-                user.payed = settings["create_paid_users"]
+                user.payed = tenant().settings["create_paid_users"]
                 session.add(user)
                 session.commit()
                 logger.info(bms.user_created.format(id=user.id))
             else:
                 logger.info(bms.user_exists.format(id=user.id))
-            if not user.payed:
-                payment_id, confirmation_url = create_payment()
-                user.payment_key = payment_id
-                user.payment_status = "pending"
+                user.last_active_time = now()
+                if user.inactive:
+                    user.inactive = False
+                    logger.info(bms.user_reactivated.format(id=user.id))
                 session.commit()
-                logger.info(f"Created payment {payment_id} for user {user.id}")
+            if not user.payed:
+                # a payment of unknown age is reused until the payment sweep
+                # looks up its creation time
+                payable = not user.payment_created_time or (
+                    now() - user.payment_created_time < PAYMENT_LIFETIME
+                )
+                if user.payment_status == "pending" and user.payment_url and payable:
+                    # the payment is still payable, send the same link again
+                    confirmation_url = user.payment_url
+                else:
+                    if user.payment_status == "pending":
+                        # YooKassa cancels payments after PAYMENT_LIFETIME,
+                        # the sweep may not have checked this one yet
+                        if await settle_stale_payment(user):
+                            session.commit()
+                            await message.answer(
+                                tenant().settings["messages"]["payment_successful"]
+                            )
+                            return
+                        session.commit()
+                    if not payments_available():
+                        await message.answer(
+                            tenant().settings["messages"]["payments_unavailable"]
+                        )
+                        logger.info(bms.payments_unavailable.format(id=user.id))
+                        return
+                    try:
+                        payment = tenant().settings["payment"]
+                        payment_id, confirmation_url = await create_payment(
+                            payment["amount"],
+                            payment["description"],
+                            await tenant().payment_return_url(),
+                        )
+                    except KassaUnavailable as e:
+                        await message.answer(
+                            tenant().settings["messages"]["payments_unavailable"]
+                        )
+                        logger.error(bms.payment_create_failed.format(id=user.id, e=e))
+                        return
+                    user.payment_key = payment_id
+                    user.payment_url = confirmation_url
+                    user.payment_status = "pending"
+                    user.payment_created_time = now()
+                    user.payment_next_check = now() + PAYMENT_CHECK_MIN_INTERVAL
+                    session.commit()
+                    logger.info(f"Created payment {payment_id} for user {user.id}")
                 keyboard = InlineKeyboardMarkup(
                     inline_keyboard=[
                         [
                             InlineKeyboardButton(
-                                text=settings["messages"]["pay_button_text"],
+                                text=tenant().settings["messages"]["pay_button_text"],
                                 url=confirmation_url,
                             )
                         ]
                     ]
                 )
                 await message.answer(
-                    settings["messages"]["welcome_message"],
+                    tenant().settings["messages"]["welcome_message"],
                     reply_markup=keyboard,
                 )
                 logger.info(bms.pay_link_sent.format(id=user.id))
             else:
-                await message.answer(settings["messages"]["already_registered"])
+                await message.answer(tenant().settings["messages"]["already_registered"])
                 logger.info(bms.wlc_back.format(id=user.id))
     else:
         logger.warning(bms.no_user_id)
 
 
+async def settle_stale_payment(user: User) -> bool:
+    """
+    Check a pending payment older than PAYMENT_LIFETIME once before it is
+    replaced, it may have been paid just before it expired. The caller
+    saves the user.
+
+    Returns:
+        bool: True if the payment succeeded and the user is marked paid.
+    """
+    try:
+        status = await get_payment_status(user.payment_key)
+    except Exception as e:
+        logger.warning(bms.payment_check_failed.format(id=user.id, e=e))
+        status = None
+    if status == "succeeded":
+        user.payed = True
+        user.payment_status = "succeeded"
+        logger.info(bms.payment_confirmed.format(id=user.id))
+        return True
+    user.payment_status = "expired"
+    logger.info(bms.payment_expired.format(id=user.id))
+    return False
+
+
+# step index new uploads are appended to, per (tenant, admin) in upload mode
+upload_targets: dict[tuple[str, int], int] = {}
+
+
 @dp.message(Command("upload"))
-async def upload_command(message: Message):
+async def upload_command(message: Message, command: CommandObject):
     user_id = message.from_user.id if message.from_user else None
     if user_id:
         with Session(engine) as session:
-            user = session.get(User, user_id)
+            user = get_user(session, user_id)
             if user and user.is_admin:
+                if command.args:
+                    # /upload N: enable upload mode adding files to step N
+                    script = get_script()
+                    arg = command.args.strip()
+                    if not arg.isdigit() or not 1 <= int(arg) <= len(script):
+                        await message.answer(
+                            bms.upload_target_invalid.format(count=len(script))
+                        )
+                        return
+                    upload_targets[(current_tenant.get(), user_id)] = int(arg) - 1
+                    user.upload_mode = True
+                    session.commit()
+                    await message.answer(
+                        bms.upload_target.format(
+                            step_number=arg, title=script[int(arg) - 1]["title"]
+                        )
+                    )
+                    return
                 user.upload_mode = not user.upload_mode
+                upload_targets.pop((current_tenant.get(), user_id), None)
                 session.commit()
                 await message.answer(
                     bms.upload_mode.format(
@@ -153,7 +430,7 @@ async def login_command_handler(message: Message):
         key = message.text.split(" ")[-1]
         if key == getenv("ADMIN_PASSWORD"):
             with Session(engine) as session:
-                user = session.get(User, user_id)
+                user = get_user(session, user_id)
                 if user:
                     user.payed = True
                     user.is_admin = True
@@ -164,7 +441,7 @@ async def login_command_handler(message: Message):
                     session.add(user)
                     session.commit()
                     logger.info(bms.created_admin.format(id=user_id))
-                await message.answer(settings["messages"]["login_successful"])
+                await message.answer(tenant().settings["messages"]["login_successful"])
                 logger.info(bms.login_successful.format(admin_id=user_id))
         else:
             await message.answer("Wrong password. Send in /login <password> format")
@@ -176,14 +453,14 @@ async def logout_command(message: Message):
     user_id = message.from_user.id if message.from_user else None
     if user_id:
         with Session(engine) as session:
-            user = session.get(User, user_id)
+            user = get_user(session, user_id)
             if user:
                 user.is_admin = False
                 session.commit()
                 await message.answer("You have been logged out from admin mode.")
                 logger.info(bms.admin_logout.format(admin_id=user_id))
             else:
-                await message.answer(settings["messages"]["not_registered"])
+                await message.answer(tenant().settings["messages"]["not_registered"])
                 logger.info(bms.not_registered.format(id=user_id))
 
 
@@ -192,12 +469,13 @@ async def get_step_message_handler(message: Message):
     if message.from_user:
         user_id = message.from_user.id
         with Session(engine) as session:
-            user = session.get(User, user_id)
+            user = get_user(session, user_id)
             if not user:
-                await message.answer(settings["messages"]["not_registered"])
+                await message.answer(tenant().settings["messages"]["not_registered"])
                 logger.info(bms.not_registered.format(id=user_id))
             else:
                 if user.is_admin:
+                    script = get_script()
                     row_count = len(script) // 3 + (1 if len(script) % 3 != 0 else 0)
                     step_buttons = []
                     row = []
@@ -223,25 +501,84 @@ async def get_step_message_handler(message: Message):
                     keyboard = InlineKeyboardMarkup(inline_keyboard=step_buttons)
                     await message.answer("Select a step:", reply_markup=keyboard)
                 else:
-                    await message.answer(settings["messages"]["not_admin"])
+                    await message.answer(tenant().settings["messages"]["not_admin"])
                     logger.info(bms.get_step_not_admin.format(id=user_id))
 
 
+@dp.message(Command("broadcast"))
+async def broadcast_command_handler(message: Message, command: CommandObject):
+    if message.from_user:
+        user_id = message.from_user.id
+        with Session(engine) as session:
+            user = get_user(session, user_id)
+            if not user or not user.is_admin:
+                await message.answer(tenant().settings["messages"]["not_admin"])
+                logger.info(bms.broadcast_not_admin.format(id=user_id))
+                return
+        # /broadcast all|paid|N text, N selects users on step N
+        parts = (command.args or "").split(maxsplit=1)
+        if len(parts) < 2 or not (
+            parts[0] in ("all", "paid") or (parts[0].isdigit() and int(parts[0]) >= 1)
+        ):
+            await message.answer(bms.broadcast_usage)
+            return
+        target, text = parts
+        broadcast = create_broadcast(
+            text,
+            paid_only=target == "paid",
+            step=int(target) if target.isdigit() else None,
+        )
+        await message.answer(
+            bms.broadcast_queued.format(id=broadcast.id, total=broadcast.total)
+        )
+        logger.info(
+            bms.broadcast_created.format(
+                id=broadcast.id, admin_id=user_id, total=broadcast.total
+            )
+        )
+
+
+@dp.message(Command("timezone"))
+async def timezone_command_handler(message: Message):
+    if message.from_user and message.text:
+        user_id = message.from_user.id
+        args = message.text.split(maxsplit=1)
+        utc_offset = parse_utc_offset(args[1]) if len(args) > 1 else None
+        if utc_offset is None:
+            await message.answer(tenant().settings["messages"]["timezone_invalid"])
+            return
+        with Session(engine) as session:
+            user = get_user(session, user_id)
+            if user:
+                user.utc_offset = utc_offset
+                session.commit()
+                await message.answer(
+                    tenant().settings["messages"]["timezone_set"].format(
+                        timezone=format_utc_offset(utc_offset)
+                    )
+                )
+                logger.info(bms.timezone_set.format(id=user_id, offset=utc_offset))
+            else:
+                await message.answer(tenant().settings["messages"]["not_registered"])
+                logger.info(bms.not_registered.format(id=user_id))
+
+
 @dp.message(Command("reset"))
 async def reset_command_handler(message: Message):
     if message.from_user:
         user_id = message.from_user.id
         with Session(engine) as session:
-            user = session.get(User, user_id)
+            user = get_user(session, user_id)
             if user:
                 user.current_step = 0
+                user.delivered_items = 0
                 user.step_sent_time = 0.0
                 user.next_step_invite_sent = False
                 session.commit()
-                await message.answer(settings["messages"]["progress_reset"])
+                await message.answer(tenant().settings["messages"]["progress_reset"])
                 logger.info(bms.progress_reset.format(id=user_id))
             else:
-                await message.answer(settings["messages"]["not_registered"])
+                await message.answer(tenant().settings["messages"]["not_registered"])
                 logger.info(bms.not_registered.format(id=user_id))
 
 
@@ -251,53 +588,88 @@ async def delete_me_command_handler(message: Message):
     if message.from_user:
         user_id = message.from_user.id
         with Session(engine) as session:
-            user = session.get(User, user_id)
+            user = get_user(session, user_id)
             if user:
                 session.delete(user)
                 session.commit()
                 await message.answer("Your data has been deleted from the database.")
                 logger.info(f"User {user_id} data deleted from database.")
             else:
-                await message.answer(settings["messages"]["not_registered"])
+                await message.answer(tenant().settings["messages"]["not_registered"])
                 logger.info(bms.not_registered.format(id=user_id))
 
 
-async def send_step_content(user_id: int, step_number: int) -> bool:
-    errors = False
-    for content in script[step_number]["content"]:
+async def send_step_content(user_id: int, step_number: int, start: int = 0) -> int:
+    """
+    Send content items of a step in order, stopping at the first failure.
+
+    Args:
+        user_id (int): Telegram user id.
+        step_number (int): Index of the step in the script.
+        start (int): Index of the first content item to send, used to resume
+            a partially delivered step.
+
+    Returns:
+        int: Index of the first item that was not delivered. Equals the
+        number of content items when the whole step was delivered.
+    """
+    contents = get_script()[step_number]["content"]
+    for index in range(start, len(contents)):
+        content = contents[index]
         try:
             if content["type"] == "text":
-                await bot.send_message(user_id, content["value"], protect_content=True)
+                await tenant().bot.send_message(user_id, content["value"], protect_content=True)
             else:
                 file_id = content["file_id"]
+                path = content.get("path", "")
                 if file_id:
-                    caption = content["caption"]
-                    if content["type"] == "photo":
-                        await bot.send_photo(
-                            user_id, file_id, caption=caption, protect_content=True
-                        )
-                    if content["type"] == "video":
-                        await bot.send_video(
-                            user_id, file_id, caption=caption, protect_content=True
-                        )
-                    if content["type"] == "audio":
-                        await bot.send_audio(
-                            user_id, file_id, caption=caption, protect_content=True
-                        )
-                    if content["type"] == "voice":
-                        await bot.send_voice(
-                            user_id, file_id, caption=caption, protect_content=True
-                        )
-                    if content["type"] == "video note":
-                        await bot.send_video_note(
-                            user_id, file_id, protect_content=True
-                        )
-                    if content["type"] == "document":
-                        await bot.send_document(user_id, file_id, caption=caption)
+                    await send_file(user_id, content, file_id)
+                elif path:
+                    await media.send_local_file(
+                        tenant().bot.id,
+                        path,
+                        lambda file: send_file(user_id, content, file),
+                    )
         except Exception as e:
             logger.error(bms.send_fail.format(type=content["type"], id=user_id, e=e))
-            errors = True
-    return not errors
+            return index
+    return len(contents)
+
+
+async def send_file(user_id: int, content: dict, file: str | FSInputFile) -> Message:
+    """
+    Send a single media content item.
+
+    Args:
+        user_id (int): Telegram user id.
+        content (dict): Content item from the script.
+        file (str | FSInputFile): Telegram file_id or local file to upload.
+
+    Returns:
+        Message: The sent message.
+    """
+    caption = content["caption"]
+    if content["type"] == "photo":
+        return await tenant().bot.send_photo(
+            user_id, file, caption=caption, protect_content=True
+        )
+    if content["type"] == "video":
+        return await tenant().bot.send_video(
+            user_id, file, caption=caption, protect_content=True
+        )
+    if content["type"] == "audio":
+        return await tenant().bot.send_audio(
+            user_id, file, caption=caption, protect_content=True
+        )
+    if content["type"] == "voice":
+        return await tenant().bot.send_voice(
+            user_id, file, caption=caption, protect_content=True
+        )
+    if content["type"] == "video note":
+        return await tenant().bot.send_video_note(user_id, file, protect_content=True)
+    if content["type"] == "document":
+        return await tenant().bot.send_document(user_id, file, caption=caption)
+    raise ValueError(f"Unknown content type {content['type']}")
 
 
 @dp.callback_query(F.data.startswith("admin_get_step="))
@@ -312,7 +684,7 @@ async def admin_get_step_handler(callback_query: CallbackQuery):
             )
         )
         with Session(engine) as session:
-            user = session.get(User, user_id)
+            user = get_user(session, user_id)
             if user and user.is_admin:
                 await send_step_content(user_id, step_number)
                 await callback_query.answer()
@@ -338,51 +710,61 @@ async def get_step_command_handler(callback_query: CallbackQuery):
         user_id = callback_query.from_user.id
         logger.info(bms.next_request.format(id=user_id))
         with Session(engine) as session:
-            user = session.get(User, user_id)
+            user = get_user(session, user_id)
+            if user:
+                user.last_active_time = now()
+                session.commit()
             if not user:
-                await callback_query.answer(settings["messages"]["not_registered"])
+                await callback_query.answer(tenant().settings["messages"]["not_registered"])
                 logger.info(bms.not_registered.format(id=user_id))
             elif not user.payed:
-                await callback_query.answer(settings["messages"]["not_payed"])
+                await callback_query.answer(tenant().settings["messages"]["not_payed"])
                 logger.info(bms.not_payed.format(id=user_id))
                 return
             elif user.step_sent_time:
-                await callback_query.answer(settings["messages"]["step_sent"])
+                await callback_query.answer(tenant().settings["messages"]["step_sent"])
                 logger.info(bms.step_sent.format(id=user_id))
                 await callback_query.answer()
                 return
-            elif user.current_step >= len(script):
-                await bot.send_message(
-                    user_id, settings["messages"]["script_completed"]
+            elif user.current_step >= len(get_script()):
+                await tenant().bot.send_message(
+                    user_id, tenant().settings["messages"]["script_completed"]
                 )
                 logger.info(bms.script_completed.format(id=user_id))
                 return
             else:
-                if await send_step_content(user_id, user.current_step):
+                delivered = await send_step_content(
+                    user_id, user.current_step, user.delivered_items
+                )
+                if delivered == len(get_script()[user.current_step]["content"]):
+                    user.delivered_items = 0
                     user.step_sent_time = now()
                     user.next_step_invite_sent = False
                     user.current_step += 1
                     session.commit()
-                    if user.current_step >= len(script):
-                        await bot.send_message(
-                            user_id, settings["messages"]["script_completed"]
+                    if user.current_step >= len(get_script()):
+                        await tenant().bot.send_message(
+                            user_id, tenant().settings["messages"]["script_completed"]
                         )
                         logger.info(bms.script_completed.format(id=user_id))
                     else:
-                        value: int = settings["next_step_delay"]["value"]
-                        if settings["next_step_delay"]["type"] == "Fixed time":
+                        value: int = tenant().settings["next_step_delay"]["value"]
+                        tz_name = format_utc_offset(user.utc_offset)
+                        if tenant().settings["next_step_delay"]["type"] == "Fixed time":
                             hh = value // 3600
                             mm = (value % 3600) // 60
-                            time_str = f"{hh:02}:{mm:02} МСК"
-                        elif settings["next_step_delay"]["type"] == "Period":
-                            td = timedelta(seconds=value)
-                            dt = datetime.fromtimestamp(user.step_sent_time) + td
-                            time_str = dt.strftime("%H:%M") + " МСК"
+                            time_str = f"{hh:02}:{mm:02} {tz_name}"
+                        elif tenant().settings["next_step_delay"]["type"] == "Period":
+                            dt = datetime.fromtimestamp(
+                                user.step_sent_time + value,
+                                user_timezone(user.utc_offset),
+                            )
+                            time_str = dt.strftime("%H:%M") + f" {tz_name}"
                         else:
                             raise ValueError("Invalid next_step_delay type")
-                        await bot.send_message(
+                        await tenant().bot.send_message(
                             user_id,
-                            settings["messages"]["next_step_timeout"].format(
+                            tenant().settings["messages"]["next_step_timeout"].format(
                                 time=time_str
                             ),
                         )
@@ -393,8 +775,11 @@ async def get_step_command_handler(callback_query: CallbackQuery):
                         )
                     )
                 else:
+                    # keep the cursor so the retry resumes from the failed item
+                    user.delivered_items = delivered
+                    session.commit()
                     await callback_query.answer(
-                        settings["messages"]["step_send_error"].format(
+                        tenant().settings["messages"]["step_send_error"].format(
                             step_number=user.current_step,
                             id=user_id,
                         ),
@@ -413,194 +798,634 @@ async def default_message_handler(message: Message):
     if message.text:
         id = message.from_user.id if message.from_user else "unknown"
         logger.info(bms.on_message.format(id=id, text=message.text))
-        await message.answer(settings["messages"]["on_message"])
+        await message.answer(tenant().settings["messages"]["on_message"])
     else:
         user_id = message.from_user.id if message.from_user else None
         if user_id:
+            if message.media_group_id:
+                album = _albums.get(message.media_group_id)
+                if album is not None:
+                    # upload mode was checked for the first message
+                    album.append(message)
+                    return
             with Session(engine) as session:
-                user = session.get(User, user_id)
-                if user and user.upload_mode:
-                    if message.photo:
-                        await message.reply(message.photo[-1].file_id)
-                    if message.video:
-                        await message.reply(message.video.file_id)
-                    if message.video_note:
-                        await message.reply(message.video_note.file_id)
-                    if message.document:
-                        await message.reply(message.document.file_id)
-                    if message.audio:
-                        await message.reply(message.audio.file_id)
-                    if message.voice:
-                        await message.reply(message.voice.file_id)
+                user = get_user(session, user_id)
+                if not user or not user.upload_mode:
+                    return
+            if message.media_group_id:
+                _albums[message.media_group_id] = [message]
+                await asyncio.sleep(ALBUM_WINDOW)
+                await reply_uploads(user_id, _albums.pop(message.media_group_id))
+            else:
+                await reply_uploads(user_id, [message])
+
+
+# messages of albums sent in upload mode by media_group_id, the messages of
+# an album arrive as separate updates and are answered together
+_albums: dict[str, list[Message]] = {}
+ALBUM_WINDOW = 1
+
+
+async def reply_uploads(user_id: int, messages: list[Message]):
+    """
+    Reply with file_ids of the uploaded media, one reply per album. If the
+    admin chose a step with /upload N, the files are appended to it.
+    """
+    uploads = [
+        (content, message.caption or "")
+        for message in messages
+        if (content := media.message_content(message))
+    ]
+    if not uploads:
+        return
+    lines = [f"{content_type}: {file_id}" for (content_type, file_id), _ in uploads]
+    target = upload_targets.get((current_tenant.get(), user_id))
+    if target is not None:
+        # read the stored script, the cached one may miss a save made within
+        # the last SCRIPT_CHECK_INTERVAL
+        _, script = load_script()
+        if target < len(script):
+            step = script[target]
+            step["content"] = step["content"] + [
+                {"type": content_type, "file_id": file_id, "path": "", "caption": caption}
+                for (content_type, file_id), caption in uploads
+            ]
+            save_script(script, [target])
+            lines.append(
+                bms.upload_added.format(count=len(uploads), step_number=target + 1)
+            )
+            logger.info(
+                bms.upload_added.format(count=len(uploads), step_number=target + 1)
+            )
+    await messages[0].reply("\n".join(lines))
+
+
+PAYMENT_CHECK_MIN_INTERVAL = 5
+PAYMENT_CHECK_MAX_INTERVAL = 300
+PAYMENT_RECONCILE_INTERVAL = 10
+
+
+def payment_check_interval(age: float) -> float:
+    """
+    Get the delay before the next status check of a pending payment. Fresh
+    payments are checked often, old ones less and less often.
+
+    Args:
+        age (float): Seconds since the payment was created.
+    """
+    return min(PAYMENT_CHECK_MAX_INTERVAL, max(PAYMENT_CHECK_MIN_INTERVAL, age / 4))
 
 
 async def check_payments():
-    while True:
+    lanes.current_lane.set(lanes.BULK)
+    while not shutdown.is_set():
         try:
-            with Session(engine) as session:
-                users = session.exec(
-                    select(User).where(
-                        User.payment_status == "pending",
-                        User.payed == False,
-                    )
-                ).all()
-                if users:
-                    for user in users:
-                        logger.info(bms.check_payment.format(id=user.id))
-                        status = get_payment_status(user.payment_key)
-                        if status == "succeeded":
-                            user.payed = True
-                            user.payment_status = "succeeded"
-                            session.commit()
-                            logger.info(bms.payment_confirmed.format(id=user.id))
-                            await bot.send_message(
-                                chat_id=user.id,
-                                text=settings["messages"]["payment_successful"],
-                            )
-                        elif status == "canceled":
-                            user.payment_status = "canceled"
-                            session.commit()
-                            logger.info(bms.payment_canceled.format(id=user.id))
-                            await bot.send_message(
-                                chat_id=user.id,
-                                text=settings["messages"]["payment_canceled"],
-                            )
-                        await asyncio.sleep(1)  # avoid hammering the payment API
-                else:
-                    await asyncio.sleep(1)
+            # payments of all tenants are reconciled at once, so it is on
+            # when any tenant enables it
+            if any(t.settings["reconcile_payments"] for t in tenants.values()):
+                await reconcile_pending_payments()
+                await pause(PAYMENT_RECONCILE_INTERVAL)
+            elif not await poll_pending_payments():
+                await pause(1)
+            health.beat("check_payments")
         except Exception as e:
             logger.error(f"Failed to check payments: {e}")
+            await pause(PAYMENT_RECONCILE_INTERVAL)
+
+
+async def poll_pending_payments() -> bool:
+    """
+    Check pending payments that are due for a check one by one.
+
+    Returns:
+        bool: True if any payment was checked.
+    """
+    checked = False
+    for users in (
+        users
+        for _ in each_tenant()
+        for users in iter_user_chunks(
+            User.payment_status == "pending",
+            User.payed == False,
+            User.inactive == False,
+            User.payment_next_check <= now(),
+        )
+    ):
+        for user in users:
+            if shutdown.is_set():
+                return checked
+            checked = True
+            logger.info(bms.check_payment.format(id=user.id))
+            try:
+                status = await get_payment_status(user.payment_key)
+            except Exception as e:
+                # a payment that can't be checked is handled as still
+                # pending, so it gets its next check later or expires
+                # and the sweep moves on to the other users
+                logger.warning(bms.payment_check_failed.format(id=user.id, e=e))
+                if isinstance(e, KassaUnavailable) and not payments_available():
+                    return checked
+                status = None
+            if status == "succeeded":
+                await writer.submit(
+                    set_users, [user.id], payed=True, payment_status="succeeded"
+                )
+                logger.info(bms.payment_confirmed.format(id=user.id))
+                await notify_payment(user, tenant().settings["messages"]["payment_successful"])
+            elif status == "canceled":
+                await writer.submit(set_users, [user.id], payment_status="canceled")
+                logger.info(bms.payment_canceled.format(id=user.id))
+                await notify_payment(user, tenant().settings["messages"]["payment_canceled"])
+            elif not user.payment_created_time:
+                # pending payment created before payment ages were
+                # tracked, start its lifetime now
+                await writer.submit(
+                    set_users,
+                    [user.id],
+                    payment_created_time=now(),
+                    payment_next_check=now() + PAYMENT_CHECK_MIN_INTERVAL,
+                )
+            else:
+                age = now() - user.payment_created_time
+                if age > PAYMENT_LIFETIME:
+                    await writer.submit(set_users, [user.id], payment_status="expired")
+                    logger.info(bms.payment_expired.format(id=user.id))
+                else:
+                    await writer.submit(
+                        set_users,
+                        [user.id],
+                        payment_next_check=now() + payment_check_interval(age),
+                    )
+            health.beat("check_payments")
+            await pause(1)  # avoid hammering the payment API
+    return checked
 
 
-NEXT_STEP_KBD = InlineKeyboardMarkup(
-    inline_keyboard=[
-        [
-            InlineKeyboardButton(
-                text=settings["messages"]["next_step_button"],
-                callback_data="get_step",
+async def reconcile_pending_payments():
+    """
+    Update all pending payments from a few YooKassa list queries: every
+    payment that succeeded or was canceled since the oldest pending payment
+    was created is matched to users by payment key in bulk updates.
+    """
+    # payments created before creation times were tracked need one lookup
+    # to get into the reconciliation window
+    for users in (
+        users
+        for _ in each_tenant()
+        for users in iter_user_chunks(
+            User.payment_status == "pending",
+            User.payed == False,
+            User.inactive == False,
+            User.payment_created_time == 0,
+        )
+    ):
+        for user in users:
+            if shutdown.is_set():
+                return
+            try:
+                created_time = await get_payment_created_time(user.payment_key)
+            except Exception as e:
+                # start the lifetime now, the payment expires if it is
+                # never confirmed
+                logger.warning(bms.payment_check_failed.format(id=user.id, e=e))
+                if isinstance(e, KassaUnavailable) and not payments_available():
+                    return
+                created_time = None
+            await writer.submit(
+                set_users, [user.id], payment_created_time=created_time or now()
             )
+            health.beat("check_payments")
+            await pause(1)  # avoid hammering the payment API
+
+    oldest = oldest_pending_payment()
+    if oldest is None:
+        return
+    # a little slack for clock differences with YooKassa
+    statuses = await reconcile_payments(oldest - 60)
+    succeeded = [key for key, status in statuses.items() if status == "succeeded"]
+    canceled = [key for key, status in statuses.items() if status == "canceled"]
+
+    users = await writer.submit(
+        settle_payments, succeeded, payed=True, payment_status="succeeded"
+    )
+    for user in users:
+        logger.info(bms.payment_confirmed.format(id=user.id))
+        current_tenant.set(user.tenant)
+        await notify_payment(user, tenant().settings["messages"]["payment_successful"])
+    users = await writer.submit(settle_payments, canceled, payment_status="canceled")
+    for user in users:
+        logger.info(bms.payment_canceled.format(id=user.id))
+        current_tenant.set(user.tenant)
+        await notify_payment(user, tenant().settings["messages"]["payment_canceled"])
+
+    expired = await writer.submit(expire_payments, now() - PAYMENT_LIFETIME)
+    if expired:
+        logger.info(bms.payments_expired.format(count=expired))
+
+
+async def notify_payment(user: User, text: str):
+    if not await notify_user(user, text) and user.inactive:
+        await writer.submit(set_users, [user.id], inactive=True)
+
+
+def next_step_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text=tenant().settings["messages"]["next_step_button"],
+                    callback_data="get_step",
+                )
+            ]
         ]
-    ]
-)
+    )
 
 
-async def send_invite(user: User) -> bool:
-    step = script[user.current_step]
+def is_unreachable(e: Exception) -> bool:
+    """
+    Check if a send error means the user can't receive messages anymore:
+    the bot was blocked, the account was deactivated or the chat is gone.
+    """
+    if isinstance(e, TelegramForbiddenError):
+        return True
+    return isinstance(e, TelegramBadRequest) and "chat not found" in e.message.lower()
+
+
+async def notify_user(
+    user: User, text: str, reply_markup: InlineKeyboardMarkup | None = None
+) -> bool:
+    """
+    Send a message to a user from a background task. If the user blocked the
+    bot, the user is marked inactive so background scans skip it until the
+    next /start. The caller is responsible for saving the inactive flag.
+
+    Returns:
+        bool: True if the message was sent.
+    """
     try:
-        await bot.send_message(
-            chat_id=user.id,
-            text=settings["messages"]["step_invite"].format(
-                title=step["title"],
-                description=step["description"],
-                step_number=user.current_step + 1,
-            ),
-            reply_markup=NEXT_STEP_KBD,
-        )
-        logger.info(bms.step_invite.format(id=user.id))
+        await tenant().bot.send_message(chat_id=user.id, text=text, reply_markup=reply_markup)
         return True
     except Exception as e:
-        logger.error(bms.message_failed.format(id=user.id, e=e))
+        if is_unreachable(e):
+            user.inactive = True
+            logger.info(bms.user_inactive.format(id=user.id, e=e))
+        else:
+            logger.error(bms.message_failed.format(id=user.id, e=e))
         return False
 
 
-async def send_invites(time_threshold: float):
-    with Session(engine) as session:
-        users = session.exec(
-            select(User).where(
-                User.payed == True,
-                User.current_step < len(script),
-                User.step_sent_time < time_threshold,
-                User.next_step_invite_sent == False,
-            )
-        ).all()
-        for user in users:
-            if await send_invite(user):
-                user.next_step_invite_sent = True
-                user.step_sent_time = 0.0
-                session.commit()
+async def send_invite(user: User) -> bool:
+    step = get_script()[user.current_step]
+    text = tenant().settings["messages"]["step_invite"].format(
+        title=step["title"],
+        description=step["description"],
+        step_number=user.current_step + 1,
+    )
+    if await notify_user(user, text, reply_markup=next_step_keyboard()):
+        logger.info(bms.step_invite.format(id=user.id))
+        return True
+    return False
 
 
-async def invite_zero_steppers():
-    with Session(engine) as session:
-        users = session.exec(
-            select(User).where(
-                User.payed == True,
-                User.current_step == 0,
-                User.next_step_invite_sent == False,
+async def invite_users(*criteria: Any):
+    """
+    Send next step invites to active users that match the criteria and
+    have not been invited yet. Users are loaded in chunks, delivered invites
+    are saved with one update per chunk.
+    """
+    for users in iter_user_chunks(
+        User.next_step_invite_sent == False,
+        User.inactive == False,
+        *criteria,
+    ):
+        invited: list[int] = []
+        inactive: list[int] = []
+        try:
+            for user in users:
+                if shutdown.is_set():
+                    return
+                if await send_invite(user):
+                    invited.append(user.id)
+                elif user.inactive:
+                    inactive.append(user.id)
+        finally:
+            # save progress even if the loop is stopped or cancelled mid-chunk
+            await writer.submit(
+                set_users, invited, next_step_invite_sent=True, step_sent_time=0.0
             )
-        ).all()
-        for user in users:
-            if await send_invite(user):
-                user.next_step_invite_sent = True
-                user.step_sent_time = 0.0
-                session.commit()
+            await writer.submit(set_users, inactive, inactive=True)
+        # a large release takes longer than LOOP_MAX_AGE, it's still progress
+        health.beat("update_next_steps")
+
+
+async def send_invites(time_threshold: float, *criteria: Any):
+    await invite_users(
+        User.payed == True,
+        User.current_step < len(get_script()),
+        User.step_sent_time < time_threshold,
+        *criteria,
+    )
+
+
+async def invite_zero_steppers(*criteria: Any):
+    await invite_users(
+        User.payed == True,
+        User.current_step == 0,
+        *criteria,
+    )
 
 
 async def invite_admins():
-    with Session(engine) as session:
-        users = session.exec(
-            select(User).where(
-                User.is_admin == True,
-                User.current_step < len(script),
-                User.next_step_invite_sent == False,
-            )
-        ).all()
-        for user in users:
-            if await send_invite(user):
-                user.next_step_invite_sent = True
-                user.step_sent_time = 0.0
-                session.commit()
+    await invite_users(
+        User.is_admin == True,
+        User.current_step < len(get_script()),
+    )
+
+
+UTC_OFFSETS_TTL = 60
+
+# tenant -> (time loaded, offsets) of the UTC offsets used by its users
+_utc_offsets: dict[str, tuple[float, list[int]]] = {}
+# utc_offset -> (local date, delivery time, release timestamp)
+_release_times: dict[int, tuple[date, int, float]] = {}
+
+
+def get_utc_offsets() -> list[int]:
+    """
+    Get the distinct UTC offsets of users of the current tenant. The list
+    is read from the
+    utc_offset index and cached for UTC_OFFSETS_TTL seconds.
+    """
+    loaded, offsets = _utc_offsets.get(current_tenant.get(), (0.0, []))
+    if now() - loaded > UTC_OFFSETS_TTL:
+        offsets = utc_offsets()
+        _utc_offsets[current_tenant.get()] = (now(), offsets)
+    return offsets
+
+
+def release_time(utc_offset: int, delivery_time: int) -> float:
+    """
+    Get today's fixed-time release of the next step for users with the given
+    UTC offset. Computed once per local day for each offset.
+
+    Args:
+        utc_offset (int): UTC offset in minutes.
+        delivery_time (int): Delivery time in seconds from local midnight.
+
+    Returns:
+        float: Release time as a Unix timestamp.
+    """
+    now_dt = datetime.now(user_timezone(utc_offset))
+    cached = _release_times.get(utc_offset)
+    if cached and cached[:2] == (now_dt.date(), delivery_time):
+        return cached[2]
+    start_of_day = now_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    threshold = start_of_day.timestamp() + delivery_time
+    _release_times[utc_offset] = (now_dt.date(), delivery_time, threshold)
+    return threshold
 
 
 async def update_next_steps():
-    while True:
+    lanes.current_lane.set(lanes.BULK)
+    while not shutdown.is_set():
         try:
-            next_step_delay = settings["next_step_delay"]
-            if next_step_delay["type"] == "Period":
-                time_threshold = now() - next_step_delay["value"]
-                await send_invites(time_threshold)
-            if next_step_delay["type"] == "Fixed time":
-                utc_plus_3 = timezone(timedelta(hours=3))
-                now_dt = datetime.now(utc_plus_3)
-                start_of_day = now_dt.replace(
-                    hour=0, minute=0, second=0, microsecond=0
-                ).timestamp()
-                time_threshold = start_of_day + next_step_delay["value"]
-                if now() > time_threshold:
+            for t in each_tenant():
+                next_step_delay = t.settings["next_step_delay"]
+                if next_step_delay["type"] == "Period":
+                    time_threshold = now() - next_step_delay["value"]
                     await send_invites(time_threshold)
-                else:
-                    await invite_zero_steppers()
-            await invite_admins()
-            await asyncio.sleep(1)
+                if next_step_delay["type"] == "Fixed time":
+                    # users are grouped by UTC offset, each group gets its own
+                    # release time at the same local time of day
+                    for utc_offset in get_utc_offsets():
+                        time_threshold = release_time(utc_offset, next_step_delay["value"])
+                        if now() > time_threshold:
+                            await send_invites(time_threshold, User.utc_offset == utc_offset)
+                        else:
+                            await invite_zero_steppers(User.utc_offset == utc_offset)
+                await invite_admins()
+            health.beat("update_next_steps")
+            await pause(1)
         except Exception as e:
             logger.error(f"Failed to update next steps: {e}")
+            await pause(1)
+
+
+BROADCAST_POLL_INTERVAL = 5
+
+
+async def run_broadcasts():
+    lanes.current_lane.set(lanes.BULK)
+    while not shutdown.is_set():
+        try:
+            broadcast = next_broadcast(list(tenants))
+            if broadcast:
+                current_tenant.set(broadcast.tenant)
+                await send_broadcast(broadcast)
+            health.beat("run_broadcasts")
+            if not broadcast:
+                await pause(BROADCAST_POLL_INTERVAL)
+        except Exception as e:
+            logger.error(f"Failed to send broadcast: {e}")
+            await pause(BROADCAST_POLL_INTERVAL)
+
+
+async def send_broadcast(broadcast: Broadcast):
+    """
+    Send a broadcast starting after its last_user_id. Progress is saved
+    after every chunk of recipients and when the bot stops, a canceled
+    broadcast stops at the next chunk.
+    """
+    assert broadcast.id is not None
+    if broadcast.status == "pending":
+        await writer.submit(
+            set_broadcast, broadcast.id, status="running", started_time=now()
+        )
+        logger.info(bms.broadcast_started.format(id=broadcast.id))
+    sent, failed = broadcast.sent, broadcast.failed
+    last_user_id = broadcast.last_user_id
+    for users in iter_user_chunks(
+        *broadcast_criteria(broadcast), after_id=last_user_id
+    ):
+        if broadcast_status(broadcast.id) != "running":
+            logger.info(bms.broadcast_canceled.format(id=broadcast.id))
+            return
+        inactive: list[int] = []
+        try:
+            for user in users:
+                if shutdown.is_set():
+                    return
+                if await notify_user(user, broadcast.text):
+                    sent += 1
+                else:
+                    failed += 1
+                    if user.inactive:
+                        inactive.append(user.id)
+                last_user_id = user.id
+        finally:
+            await writer.submit(
+                set_broadcast,
+                broadcast.id,
+                sent=sent,
+                failed=failed,
+                last_user_id=last_user_id,
+            )
+            await writer.submit(set_users, inactive, inactive=True)
+        health.beat("run_broadcasts")
+    if broadcast_status(broadcast.id) == "running":
+        await writer.submit(
+            set_broadcast, broadcast.id, status="done", finished_time=now()
+        )
+        logger.info(
+            bms.broadcast_finished.format(id=broadcast.id, sent=sent, failed=failed)
+        )
+
+
+# Finished, abandoned unpaid and blocked users who didn't send /start or ask
+# for a step for this many seconds (User.last_active_time) are moved to the
+# archive table, get_user brings them back on interaction.
+ARCHIVE_AFTER = int(getenv("ARCHIVE_AFTER", 30 * 24 * 3600))
+ARCHIVE_INTERVAL = 3600
+
+
+async def archive_tenant_users(t: Tenant):
+    script_length = len(t.get_script())
+    before = now() - ARCHIVE_AFTER
+    restored = await writer.submit(unarchive_unfinished, script_length)
+    if restored:
+        logger.info(bms.users_unarchived.format(count=restored))
+    archived = 0
+    for users in iter_user_chunks(
+        User.is_admin == False,
+        User.last_active_time < before,
+        or_(
+            User.current_step >= script_length,
+            and_(
+                User.payed == False,
+                User.payment_status.in_(["", "expired", "canceled"]),  # type: ignore
+            ),
+            User.inactive == True,
+        ),
+    ):
+        if shutdown.is_set():
+            break
+        archived += await writer.submit(
+            archive_users, [user.id for user in users], now()
+        )
+    if archived:
+        logger.info(bms.users_archived.format(count=archived))
+
+
+async def archive_stale_users():
+    lanes.current_lane.set(lanes.BULK)
+    while not shutdown.is_set():
+        try:
+            for t in each_tenant():
+                await archive_tenant_users(t)
+            health.beat("archive_stale_users")
+        except Exception as e:
+            logger.error(f"Failed to archive users: {e}")
+        await pause(ARCHIVE_INTERVAL)
 
 
 async def reload_settings():
-    while True:
+    while not shutdown.is_set():
         try:
-            global settings
-            global script
-            settings = json.load(open("settings.json", "r", encoding="utf-8"))
-            script = json.load(open("script.json", "r", encoding="utf-8"))
+            for t in tenants.values():
+                t.settings = load_settings(t.directory)
+            health.beat("reload_settings")
             # logger.info("Settings reloaded")
-            await asyncio.sleep(10)  # reload every 10 seconds
         except Exception as e:
             logger.error(f"Failed to reload settings: {e}")
+        await pause(10)  # reload every 10 seconds
+
+
+@dp.update.outer_middleware()
+async def first_update_middleware(handler, event, data):
+    global _started
+    if _started is not None:
+        logger.info(
+            bms.first_update.format(ms=(timer.perf_counter() - _started) * 1000)
+        )
+        _started = None
+    return await handler(event, data)
+
+
+# seconds a background loop may go without completing an iteration before
+# /health reports it stalled
+LOOP_MAX_AGE = {
+    "check_payments": 300,
+    "update_next_steps": 900,
+    "reload_settings": 60,
+    "run_broadcasts": 300,
+    "archive_stale_users": 2 * ARCHIVE_INTERVAL,
+}
+# local port of the health endpoint, disabled when not set
+HEALTH_HOST = getenv("HEALTH_HOST", "127.0.0.1")
+HEALTH_PORT = int(getenv("HEALTH_PORT", "0"))
+
+
+@dp.startup()
+async def on_startup():
+    health.ready = True
+
 
 async def main():
-    logger.info("Creating database tables")
-    SQLModel.metadata.create_all(engine)
+    if create_db_and_tables():
+        logger.info("Created database tables")
+    logger.info(bms.startup_time.format(ms=(timer.perf_counter() - _started) * 1000))
+    writer.start()
     logger.info("Starting payment checking task")
-    asyncio.create_task(check_payments())
+    tasks = [asyncio.create_task(check_payments())]
     logger.info("Starting next step update task")
-    asyncio.create_task(update_next_steps())
+    tasks.append(asyncio.create_task(update_next_steps()))
     logger.info("Starting settings reload task")
-    asyncio.create_task(reload_settings())
+    tasks.append(asyncio.create_task(reload_settings()))
+    logger.info("Starting broadcast task")
+    tasks.append(asyncio.create_task(run_broadcasts()))
+    logger.info("Starting user archiving task")
+    tasks.append(asyncio.create_task(archive_stale_users()))
+    for name, max_age in LOOP_MAX_AGE.items():
+        health.watch(name, max_age)
+    health_server = HealthServer(
+        lambda: {name: len(t.get_script()) for name, t in tenants.items()},
+        writer.size,
+        lambda: {name or "default": t.limiter.stats() for name, t in tenants.items()},
+        lambda: dict(throttling.throttled),
+    )
+    if HEALTH_PORT:
+        await health_server.start(HEALTH_HOST, HEALTH_PORT)
     logger.info("Starting bot polling")
-    await dp.start_polling(bot)
+    try:
+        # returns on SIGINT / SIGTERM, the session is closed below after
+        # background tasks have finished sending
+        await dp.start_polling(
+            *[t.bot for t in tenants.values()], close_bot_session=False
+        )
+    finally:
+        health.ready = False
+        await stop_background_tasks(tasks)
+        await health_server.stop()
+        for t in tenants.values():
+            await t.bot.session.close()
     logger.info("Bot has stopped")
 
 
+async def stop_background_tasks(tasks: list[asyncio.Task]):
+    """
+    Stop background tasks: let them finish the message being sent and save
+    their progress, cancel the ones still running after SHUTDOWN_TIMEOUT,
+    then commit queued database writes.
+    """
+    logger.info("Stopping background tasks")
+    shutdown.set()
+    _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+    for task in pending:
+        logger.warning(f"Background task {task.get_coro().__name__} did not stop in time, cancelling")
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    await writer.stop()
+
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -20,7 +20,15 @@ step_sent_success = "Sent step {step_number} to user {id}"
 check_payment = "Checking payment status for user {id}"
 payment_confirmed = "Payment confirmed for user {id}"
 payment_canceled = "Payment was canceled for user {id}"
+payment_expired = "Payment of user {id} expired without confirmation"
+payments_expired = "{count} payments expired without confirmation"
+payments_unavailable = "Payments are unavailable, sent notice to user {id}"
+payment_create_failed = "Failed to create payment for user {id}: {e}"
+payment_check_failed = "Failed to check payment of user {id}: {e!r}"
 upload_mode = "Upload mode is now {state}."
+upload_target = "Upload mode is now enabled, files will be added to step {step_number}. {title}"
+upload_target_invalid = "Usage: /upload N, where N is a step number from 1 to {count}"
+upload_added = "Added {count} files to step {step_number}"
 login_successful = "Admin {admin_id} logged in successfully."
 admin_logout = "Admin {admin_id} logged out."
 invalid_login = "Admin {admin_id} provided invalid login credentials."
@@ -34,3 +42,18 @@ not_authorized = "You are not authorized to perform this action."
 step_send_error = "Error sending step {step_number} to user {id}."
 progress_reset = "User {id} progress has been reset."
 created_admin = "Created user {id} with admin rights."
+user_inactive = "User {id} is unreachable, marked inactive: {e}"
+user_reactivated = "Inactive user {id} sent /start, marked active again"
+users_archived = "Moved {count} idle users to the archive"
+users_unarchived = "Restored {count} archived users that have new steps"
+broadcast_not_admin = "User {id} tried to send a broadcast but is not an admin"
+broadcast_usage = "Usage: /broadcast all|paid|N text, N sends to users on step N"
+broadcast_queued = "Broadcast {id} queued for {total} users"
+broadcast_created = "Admin {admin_id} queued broadcast {id} for {total} users"
+broadcast_started = "Started broadcast {id}"
+broadcast_finished = "Broadcast {id} finished: {sent} sent, {failed} failed"
+broadcast_canceled = "Broadcast {id} was canceled"
+timezone_set = "User {id} set UTC offset to {offset} minutes"
+script_imported = "Imported {path} into the database as script version {version}"
+startup_time = "Started in {ms:.0f} ms, waiting for updates"
+first_update = "First update received {ms:.0f} ms after start"
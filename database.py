@@ -0,0 +1,856 @@
+import json
+import time
+from contextlib import contextmanager
+from os import getenv
+
+from dotenv import load_dotenv
+from contextvars import ContextVar
+from typing import Any, Iterable, Iterator
+
+from sqlalchemy import (
+    BigInteger,
+    Connection,
+    Engine,
+    Integer,
+    MetaData,
+    Table,
+    cast,
+    delete,
+    event,
+    exc,
+    inspect,
+    insert,
+    literal,
+    text,
+    update,
+)
+from sqlmodel import Field, Session, SQLModel, create_engine, func, select
+
+
+# Bump on every schema change so create_db_and_tables migrates the database
+# on the next start. It creates missing tables and indexes and adds the
+# columns listed in ADDED_COLUMNS. Other changes, such as new column types or
+# constraints, need a migration step of their own, like
+# migrate_tenant_columns.
+SCHEMA_VERSION = 7
+
+# UTC offset in minutes of users who didn't set a time zone, Moscow time
+DEFAULT_UTC_OFFSET = 3 * 60
+
+# Name of the tenant (see tenants.py) whose users, script and broadcasts are
+# read and written by the current task. New rows get it as their tenant.
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default="")
+
+
+def tenant_field(**kwargs: Any) -> Any:
+    return Field(default_factory=current_tenant.get, **kwargs)
+
+
+class UserBase(SQLModel):
+    tenant: str = tenant_field(primary_key=True)
+    id: int = Field(primary_key=True, sa_type=BigInteger)
+    current_step: int = Field(default=0, index=True)
+    delivered_items: int = Field(default=0)
+    payment_status: str = Field(default="", index=True)
+    payment_key: str = Field(default="", index=True)
+    payment_url: str = Field(default="")
+    payment_created_time: float = Field(default=0.0)
+    payment_next_check: float = Field(default=0.0, index=True)
+    payed: bool = Field(default=False)
+    step_sent_time: float = Field(default=0.0)
+    next_step_invite_sent: bool = Field(default=False)
+    upload_mode: bool = Field(default=False)
+    is_admin: bool = Field(default=False)
+    utc_offset: int = Field(default=DEFAULT_UTC_OFFSET, index=True)
+    inactive: bool = Field(default=False, index=True)
+    # last /start or step request, set when a user is created or restored
+    last_active_time: float = Field(default_factory=time.time)
+
+
+class User(UserBase, table=True):
+    pass
+
+
+class ArchivedUser(UserBase, table=True):
+    """
+    Cold storage for finished and abandoned users, see archive_users.
+    Rows are moved back to User by get_user on the next interaction.
+    """
+
+    archived_time: float = Field(default=0.0)
+
+
+class SchemaVersion(SQLModel, table=True):
+    id: int = Field(default=1, primary_key=True)
+    version: int
+
+
+class MediaFile(SQLModel, table=True):
+    sha256: str = Field(primary_key=True)
+    bot_id: int = Field(primary_key=True, sa_type=BigInteger)
+    file_id: str
+
+
+class ScriptVersion(SQLModel, table=True):
+    tenant: str = tenant_field(primary_key=True)
+    version: int = Field(default=0)
+    updated_time: float = Field(default=0.0)
+
+
+class ScriptStep(SQLModel, table=True):
+    tenant: str = tenant_field(primary_key=True)
+    position: int = Field(primary_key=True)
+    title: str = Field(default="")
+    description: str = Field(default="")
+
+
+class ScriptContent(SQLModel, table=True):
+    tenant: str = tenant_field(primary_key=True)
+    step: int = Field(primary_key=True)
+    position: int = Field(primary_key=True)
+    type: str
+    value: str = Field(default="")
+    file_id: str = Field(default="")
+    path: str = Field(default="")
+    caption: str = Field(default="")
+
+
+class Broadcast(SQLModel, table=True):
+    """
+    A message sent to many users by a background job. The job walks the
+    recipients in id order and stores its position in last_user_id, so it
+    resumes where it stopped after a restart.
+    """
+
+    id: int | None = Field(default=None, primary_key=True)
+    tenant: str = tenant_field(index=True)
+    text: str
+    paid_only: bool = Field(default=False)
+    # only users on this step, numbered from 1 like step invites
+    step: int | None = Field(default=None)
+    status: str = Field(default="pending", index=True)
+    total: int = Field(default=0)
+    sent: int = Field(default=0)
+    failed: int = Field(default=0)
+    last_user_id: int = Field(default=0, sa_type=BigInteger)
+    created_time: float = Field(default=0.0)
+    started_time: float = Field(default=0.0)
+    finished_time: float = Field(default=0.0)
+
+
+# Columns added to tables that existed in earlier versions. create_all only
+# creates missing tables, migrate_added_columns adds these columns to
+# existing ones with the model default and creates their indexes. Default
+# factories are called once, existing rows get the value of the migration.
+ADDED_COLUMNS: list[tuple[Any, str]] = [
+    (User, "delivered_items"),
+    (User, "inactive"),
+    (User, "payment_url"),
+    (User, "payment_created_time"),
+    (User, "payment_next_check"),
+    (User, "utc_offset"),
+    (User, "last_active_time"),
+    (ArchivedUser, "last_active_time"),
+]
+
+
+load_dotenv()
+db_url = getenv("DB_URL")
+
+if db_url is None:
+    raise ValueError("DB_URL environment variable not set")
+
+# Settings for SQLite databases shared by the bot and the admin tools:
+# WAL lets readers work while a write is in progress, NORMAL sync is safe
+# with WAL and avoids an fsync per commit, busy_timeout waits for the lock
+# instead of failing with "database is locked".
+SQLITE_PRAGMAS: dict[str, Any] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative value is in KiB
+}
+
+
+def apply_sqlite_profile(engine: Engine) -> None:
+    """Set SQLITE_PRAGMAS on every new connection of the engine."""
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+engine = create_engine(db_url)
+if engine.dialect.name == "sqlite":
+    apply_sqlite_profile(engine)
+
+
+@contextmanager
+def schema_transaction() -> Iterator[Connection]:
+    """
+    Begin a transaction that also covers schema changes, so a migration
+    that fails halfway leaves the database as it was. pysqlite runs DDL
+    outside of transactions unless BEGIN is sent explicitly.
+    """
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            conn.exec_driver_sql("BEGIN")
+        yield conn
+
+
+def migrate_added_columns() -> None:
+    """Add the columns of ADDED_COLUMNS missing in existing tables."""
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for model, name in ADDED_COLUMNS:
+        table = model.__table__
+        if not inspector.has_table(table.name):
+            continue
+        if name in [column["name"] for column in inspector.get_columns(table.name)]:
+            continue
+        column = table.c[name]
+        column_type = column.type.compile(engine.dialect)
+        value = model.model_fields[name].get_default(call_default_factory=True)
+        default = literal(value, column.type).compile(
+            dialect=engine.dialect, compile_kwargs={"literal_binds": True}
+        )
+        with schema_transaction() as conn:
+            conn.execute(
+                text(
+                    f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(name)} "
+                    f"{column_type} NOT NULL DEFAULT {default}"
+                )
+            )
+            for index in table.indexes:
+                if name in index.columns:
+                    index.create(conn, checkfirst=True)
+
+
+def migrate_tenant_columns() -> None:
+    """
+    Add the tenant column to tables created by single bot versions, rows
+    are assigned to the default tenant. Tables where the tenant is a part
+    of the primary key are rebuilt: the old table is renamed, its rows are
+    copied to a new one with defaults for missing columns, then it is
+    dropped. Other tables get a new column.
+    """
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    for model in (User, ArchivedUser, ScriptVersion, ScriptStep, ScriptContent, Broadcast):
+        table = model.__table__  # type: ignore
+        if not inspector.has_table(table.name):
+            continue
+        columns = [column["name"] for column in inspector.get_columns(table.name)]
+        if "tenant" in columns:
+            continue
+        name = quote(table.name)
+        with schema_transaction() as conn:
+            if table.c.tenant.primary_key:
+                conn.execute(text(f"ALTER TABLE {name} RENAME TO {quote(table.name + '_legacy')}"))
+                legacy = Table(table.name + "_legacy", MetaData(), autoload_with=conn)
+                # index and primary key names stay with the renamed table,
+                # free them for the new one
+                for index in legacy.indexes:
+                    index.drop(conn)
+                pk_name = legacy.primary_key.name
+                if engine.dialect.name == "postgresql" and pk_name:
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE {quote(legacy.name)} RENAME CONSTRAINT "
+                            f"{quote(pk_name)} TO {quote(legacy.name + '_pkey')}"
+                        )
+                    )
+                table.create(conn)
+                values = [
+                    legacy.c[column.name]
+                    if column.name in columns
+                    else literal(
+                        ""
+                        if column.name == "tenant"
+                        else model.model_fields[column.name].get_default(
+                            call_default_factory=True
+                        ),
+                        column.type,
+                    )
+                    for column in table.columns
+                ]
+                conn.execute(
+                    insert(table).from_select(
+                        [column.name for column in table.columns], select(*values)
+                    )
+                )
+                legacy.drop(conn)
+            else:
+                column_type = table.c.tenant.type.compile(engine.dialect)
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {name} ADD COLUMN tenant {column_type} "
+                        "NOT NULL DEFAULT ''"
+                    )
+                )
+                for index in table.indexes:
+                    if "tenant" in index.columns:
+                        index.create(conn)
+
+
+def create_db_and_tables() -> bool:
+    """
+    Create missing tables and indexes and add missing columns. Skipped when
+    the schema version marker stored in the database matches SCHEMA_VERSION.
+
+    Returns:
+        bool: True if create_all was run.
+    """
+    try:
+        with Session(engine) as session:
+            marker = session.get(SchemaVersion, 1)
+            if marker and marker.version == SCHEMA_VERSION:
+                return False
+    except exc.DBAPIError:
+        pass  # no marker table yet
+    migrate_added_columns()
+    migrate_tenant_columns()
+    SQLModel.metadata.create_all(engine)
+    # create_all skips tables that exist, add indexes created since then
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    with Session(engine) as session:
+        session.merge(SchemaVersion(id=1, version=SCHEMA_VERSION))
+        session.commit()
+    return True
+
+
+def iter_user_chunks(
+    *criteria: Any, chunk_size: int = 500, after_id: int | None = None
+) -> Iterator[list[User]]:
+    """
+    Iterate over users matching the criteria in chunks ordered by id.
+
+    Each chunk is loaded with keyset pagination (id greater than the last
+    id of the previous chunk) in its own short session, so memory use and
+    lock time don't grow with the number of matching users. The returned
+    users are detached, write changes back with set_users. Pass after_id
+    to resume an earlier iteration. Only users of the current tenant are
+    returned.
+    """
+    last_id = after_id
+    while True:
+        with Session(engine) as session:
+            statement = select(User).where(User.tenant == current_tenant.get(), *criteria)
+            if last_id is not None:
+                statement = statement.where(User.id > last_id)
+            users = list(
+                session.exec(statement.order_by(User.id).limit(chunk_size)).all()  # type: ignore
+            )
+        if not users:
+            return
+        yield users
+        if len(users) < chunk_size:
+            return
+        last_id = users[-1].id
+
+
+def set_users(session: Session, ids: list[int], **values: Any) -> None:
+    """Set the same column values for users of the current tenant with the
+    given ids."""
+    if ids:
+        session.execute(
+            update(User)
+            .where(User.tenant == current_tenant.get(), User.id.in_(ids))  # type: ignore
+            .values(**values)
+        )
+
+
+def _move_users(
+    session: Session, source: Any, target: Any, ids: list[int], **values: Any
+) -> int:
+    """Copy users of the current tenant with the given ids from source to
+    target table and delete them from source. Extra target columns are set
+    from values."""
+    columns = [name for name in UserBase.model_fields if name not in values]
+    criteria = [source.tenant == current_tenant.get(), source.id.in_(ids)]
+    session.execute(
+        insert(target).from_select(
+            columns + list(values),
+            select(
+                *[getattr(source, name) for name in columns],
+                *[literal(value) for value in values.values()],
+            ).where(*criteria),
+        )
+    )
+    result = session.execute(delete(source).where(*criteria))
+    return result.rowcount  # type: ignore
+
+
+def archive_users(session: Session, ids: list[int], now: float) -> int:
+    """
+    Move users with the given ids to the ArchivedUser table.
+
+    Returns:
+        int: Number of archived users.
+    """
+    if not ids:
+        return 0
+    return _move_users(session, User, ArchivedUser, ids, archived_time=now)
+
+
+def unarchive_users(session: Session, ids: list[int], **values: Any) -> int:
+    """
+    Move archived users with the given ids back to the User table, setting
+    the given column values.
+
+    Returns:
+        int: Number of restored users.
+    """
+    if not ids:
+        return 0
+    return _move_users(session, ArchivedUser, User, ids, **values)
+
+
+def unarchive_unfinished(session: Session, script_length: int) -> int:
+    """
+    Restore archived paying users that have not reached the end of the
+    script, e.g. finished users after new steps were added.
+
+    Returns:
+        int: Number of restored users.
+    """
+    ids = session.exec(
+        select(ArchivedUser.id).where(
+            ArchivedUser.tenant == current_tenant.get(),
+            ArchivedUser.payed == True,
+            ArchivedUser.inactive == False,
+            ArchivedUser.current_step < script_length,
+        )
+    ).all()
+    restored = 0
+    for i in range(0, len(ids), 500):
+        restored += unarchive_users(session, list(ids[i : i + 500]))
+    return restored
+
+
+def restore_user(session: Session, user_id: int) -> User | None:
+    """Move an archived user back to the User table and commit. Unknown
+    users are only looked up, so the session doesn't start a write
+    transaction that would hold the SQLite write lock."""
+    if session.get(ArchivedUser, (current_tenant.get(), user_id)) is None:
+        return None
+    if not unarchive_users(session, [user_id], last_active_time=time.time()):
+        return None
+    session.commit()
+    return session.get(User, (current_tenant.get(), user_id))
+
+
+def get_user(session: Session, user_id: int) -> User | None:
+    """Get a user of the current tenant by id, restoring it from the
+    archive if needed."""
+    user = session.get(User, (current_tenant.get(), user_id))
+    return user or restore_user(session, user_id)
+
+
+def archived_users_count() -> int:
+    """Count users of the current tenant in the archive table."""
+    with Session(engine) as session:
+        return session.exec(
+            select(func.count()).where(ArchivedUser.tenant == current_tenant.get())
+        ).one()
+
+
+def utc_offsets() -> list[int]:
+    """Get the distinct UTC offsets set by users of the current tenant."""
+    with Session(engine) as session:
+        return list(
+            session.exec(
+                select(User.utc_offset)
+                .where(User.tenant == current_tenant.get())
+                .distinct()
+            ).all()
+        )
+
+
+def settle_payments(
+    session: Session, payment_keys: list[str], **values: Any
+) -> list[User]:
+    """
+    Update users of all tenants whose pending payment is one of the given
+    payments.
+
+    Returns:
+        list[User]: Detached copies of the users loaded before the update.
+    """
+    users: list[User] = []
+    # keep IN lists within SQLite's limit of query parameters
+    for i in range(0, len(payment_keys), 500):
+        criteria = [
+            User.payment_key.in_(payment_keys[i : i + 500]),  # type: ignore
+            User.payment_status == "pending",
+            User.payed == False,
+        ]
+        found = session.exec(select(User).where(*criteria)).all()
+        for user in found:
+            session.expunge(user)
+        session.execute(update(User).where(*criteria).values(**values))
+        users.extend(found)
+    return users
+
+
+def expire_payments(session: Session, created_before: float) -> int:
+    """
+    Mark pending payments created before the given time expired.
+
+    Returns:
+        int: Number of expired payments.
+    """
+    result = session.execute(
+        update(User)
+        .where(
+            User.payment_status == "pending",
+            User.payed == False,
+            User.payment_created_time > 0,
+            User.payment_created_time < created_before,
+        )
+        .values(payment_status="expired")
+    )
+    return result.rowcount  # type: ignore
+
+
+def oldest_pending_payment() -> float | None:
+    """
+    Get the creation time of the oldest pending payment of active users.
+    Payments with unknown creation time are not taken into account.
+    """
+    with Session(engine) as session:
+        return session.exec(
+            select(func.min(User.payment_created_time)).where(
+                User.payment_status == "pending",
+                User.payed == False,
+                User.inactive == False,
+                User.payment_created_time > 0,
+            )
+        ).one()
+
+
+def script_version() -> int:
+    """Get the version of the current tenant's script, 0 if none."""
+    with Session(engine) as session:
+        row = session.get(ScriptVersion, current_tenant.get())
+        return row.version if row else 0
+
+
+def script_length() -> int:
+    """Count the steps of the current tenant's script."""
+    with Session(engine) as session:
+        return session.exec(
+            select(func.count()).where(ScriptStep.tenant == current_tenant.get())
+        ).one()
+
+
+def _content_dict(content: ScriptContent) -> dict:
+    if content.type == "text":
+        return {"type": "text", "value": content.value}
+    return {
+        "type": content.type,
+        "file_id": content.file_id,
+        "path": content.path,
+        "caption": content.caption,
+    }
+
+
+def load_script() -> tuple[int, list[dict]]:
+    """
+    Load the script of the current tenant.
+
+    Returns:
+        tuple[int, list[dict]]: Script version and steps in the script.json
+        format, a list of dicts with title, description and content.
+    """
+    with Session(engine) as session:
+        # steps and content are read in the same transaction as the version
+        tenant = current_tenant.get()
+        row = session.get(ScriptVersion, tenant)
+        steps = session.exec(
+            select(ScriptStep)
+            .where(ScriptStep.tenant == tenant)
+            .order_by(ScriptStep.position)  # type: ignore
+        ).all()
+        contents = session.exec(
+            select(ScriptContent)
+            .where(ScriptContent.tenant == tenant)
+            .order_by(ScriptContent.step, ScriptContent.position)  # type: ignore
+        ).all()
+        script = [
+            {"title": step.title, "description": step.description, "content": []}
+            for step in steps
+        ]
+        for content in contents:
+            if content.step < len(script):
+                script[content.step]["content"].append(_content_dict(content))
+        return (row.version if row else 0), script
+
+
+def save_script(script: list[dict], dirty: Iterable[int]) -> int:
+    """
+    Save the script of the current tenant in one transaction and bump its
+    version. Only the steps with dirty indexes are written, steps past the
+    end of the script are deleted.
+
+    Returns:
+        int: New script version.
+    """
+    tenant = current_tenant.get()
+    with Session(engine) as session:
+        session.execute(
+            delete(ScriptStep).where(
+                ScriptStep.tenant == tenant, ScriptStep.position >= len(script)  # type: ignore
+            )
+        )
+        session.execute(
+            delete(ScriptContent).where(
+                ScriptContent.tenant == tenant, ScriptContent.step >= len(script)  # type: ignore
+            )
+        )
+        for i in sorted(set(dirty)):
+            if i >= len(script):
+                continue
+            step = script[i]
+            session.merge(
+                ScriptStep(
+                    position=i, title=step["title"], description=step["description"]
+                )
+            )
+            session.execute(
+                delete(ScriptContent).where(
+                    ScriptContent.tenant == tenant, ScriptContent.step == i
+                )
+            )
+            for j, content in enumerate(step["content"]):
+                session.add(
+                    ScriptContent(
+                        step=i,
+                        position=j,
+                        type=content["type"],
+                        value=content.get("value", ""),
+                        file_id=content.get("file_id", ""),
+                        path=content.get("path", ""),
+                        caption=content.get("caption", ""),
+                    )
+                )
+        row = session.get(ScriptVersion, tenant) or ScriptVersion()
+        row.version += 1
+        row.updated_time = time.time()
+        session.add(row)
+        session.commit()
+        return row.version
+
+
+def import_script_file(path: str) -> int:
+    """
+    Replace the script of the current tenant with the steps of a
+    script.json file.
+
+    Returns:
+        int: New script version.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        script = json.load(f)
+    return save_script(script, range(len(script)))
+
+
+def broadcast_criteria(broadcast: Broadcast) -> list[Any]:
+    """Get the filter selecting the recipients of a broadcast."""
+    criteria: list[Any] = [User.tenant == broadcast.tenant, User.inactive == False]
+    if broadcast.paid_only:
+        criteria.append(User.payed == True)
+    if broadcast.step is not None:
+        # users on step N have received N - 1 steps
+        criteria.append(User.current_step == broadcast.step - 1)
+    return criteria
+
+
+def create_broadcast(text: str, paid_only: bool, step: int | None) -> Broadcast:
+    """Queue a broadcast to users of the current tenant and count them."""
+    broadcast = Broadcast(
+        text=text, paid_only=paid_only, step=step, created_time=time.time()
+    )
+    with Session(engine) as session:
+        broadcast.total = session.exec(
+            select(func.count())
+            .select_from(User)
+            .where(*broadcast_criteria(broadcast))
+        ).one()
+        session.add(broadcast)
+        session.commit()
+        session.refresh(broadcast)
+        return broadcast
+
+
+def next_broadcast(tenants: list[str]) -> Broadcast | None:
+    """Get the oldest running or pending broadcast of the given tenants."""
+    with Session(engine) as session:
+        return session.exec(
+            select(Broadcast)
+            .where(
+                Broadcast.status.in_(["running", "pending"]),  # type: ignore
+                Broadcast.tenant.in_(tenants),  # type: ignore
+            )
+            .order_by(Broadcast.id)  # type: ignore
+        ).first()
+
+
+def set_broadcast(session: Session, broadcast_id: int, **values: Any) -> None:
+    session.execute(
+        update(Broadcast).where(Broadcast.id == broadcast_id).values(**values)  # type: ignore
+    )
+
+
+def broadcast_status(broadcast_id: int) -> str | None:
+    with Session(engine) as session:
+        broadcast = session.get(Broadcast, broadcast_id)
+        return broadcast.status if broadcast else None
+
+
+def cancel_broadcast(broadcast_id: int) -> None:
+    """Stop a pending or running broadcast."""
+    with Session(engine) as session:
+        session.execute(
+            update(Broadcast)
+            .where(
+                Broadcast.id == broadcast_id,
+                Broadcast.status.in_(["running", "pending"]),  # type: ignore
+            )
+            .values(status="canceled", finished_time=time.time())
+        )
+        session.commit()
+
+
+def recent_broadcasts(limit: int = 20) -> list[Broadcast]:
+    with Session(engine) as session:
+        return list(
+            session.exec(
+                select(Broadcast)
+                .where(Broadcast.tenant == current_tenant.get())
+                .order_by(Broadcast.id.desc())  # type: ignore
+                .limit(limit)
+            ).all()
+        )
+
+
+def invite_backlog(script_length: int) -> tuple[int, float | None]:
+    """
+    Count paying active users of the current tenant that received a step
+    and wait for the next step invite.
+
+    Returns:
+        tuple[int, float | None]: Number of users and the earliest time a
+        step was sent to one of them.
+    """
+    with Session(engine) as session:
+        count, oldest = session.exec(
+            select(func.count(), func.min(User.step_sent_time)).where(
+                User.tenant == current_tenant.get(),
+                User.payed == True,
+                User.inactive == False,
+                User.step_sent_time > 0,
+                User.next_step_invite_sent == False,
+                User.current_step < script_length,
+            )
+        ).one()
+        return count, oldest
+
+
+def payment_backlog() -> tuple[int, float | None]:
+    """
+    Count pending payments of active users of all tenants.
+
+    Returns:
+        tuple[int, float | None]: Number of payments and the creation time
+        of the oldest one with a known creation time.
+    """
+    with Session(engine) as session:
+        count = session.exec(
+            select(func.count()).where(
+                User.payment_status == "pending",
+                User.payed == False,
+                User.inactive == False,
+            )
+        ).one()
+    return count, oldest_pending_payment()
+
+
+def ping() -> None:
+    """Run a trivial query, raises if the database is unreachable."""
+    with Session(engine) as session:
+        session.exec(select(1)).one()
+
+
+def users_per_step() -> list[tuple[int, int]]:
+    """
+    Count users of the current tenant on each step of the script.
+
+    Returns:
+        list[tuple[int, int]]: (current_step, user count) ordered by step.
+    """
+    with Session(engine) as session:
+        rows = session.exec(
+            select(User.current_step, func.count())
+            .where(User.tenant == current_tenant.get())
+            .group_by(User.current_step)
+            .order_by(User.current_step)
+        ).all()
+        return [(step, count) for step, count in rows]
+
+
+def payment_status_counts() -> list[tuple[str, bool, int]]:
+    """
+    Count users of the current tenant by payment status.
+
+    Returns:
+        list[tuple[str, bool, int]]: (payment_status, payed, user count).
+    """
+    with Session(engine) as session:
+        rows = session.exec(
+            select(User.payment_status, User.payed, func.count())
+            .where(User.tenant == current_tenant.get())
+            .group_by(User.payment_status, User.payed)
+        ).all()
+        return [(status, payed, count) for status, payed, count in rows]
+
+
+def invite_lag_distribution(
+    now: float, script_length: int, bucket: int = 3600
+) -> list[tuple[int, int]]:
+    """
+    Group active users of the current tenant waiting for the next step
+    invite by how long they have been waiting since their last step was
+    sent. Users who finished the script are not waiting.
+
+    Args:
+        now (float): Current Unix timestamp.
+        script_length (int): Number of steps in the script.
+        bucket (int): Bucket width in seconds.
+
+    Returns:
+        list[tuple[int, int]]: (bucket number, user count) ordered by bucket.
+    """
+    lag = cast((now - User.step_sent_time) / bucket, Integer)
+    with Session(engine) as session:
+        rows = session.exec(
+            select(lag, func.count())
+            .where(
+                User.tenant == current_tenant.get(),
+                User.payed == True,
+                User.inactive == False,
+                User.step_sent_time > 0,
+                User.next_step_invite_sent == False,
+                User.current_step < script_length,
+            )
+            .group_by(lag)
+            .order_by(lag)
+        ).all()
+        return [(b, count) for b, count in rows]
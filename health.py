@@ -0,0 +1,179 @@
+"""Local HTTP endpoint for liveness and readiness checks.
+
+GET /health answers 200 while every background loop completed an iteration
+recently enough and 503 once one of them stalls, so a hung loop can be
+detected and the process restarted. GET /ready answers 200 when the bot is
+polling for updates and the database responds. Both return a JSON report
+with loop heartbeats, database pool status, invite and payment backlogs,
+write queue size, Bot API lane latency and throttled update counts.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Callable
+
+import database as db
+
+logger = logging.getLogger("health")
+
+# backlog queries scan the users table, their results are reused for a while
+BACKLOG_TTL = 10
+DB_TIMEOUT = 5
+REQUEST_TIMEOUT = 5
+
+# loop name to (monotonic time of the last completed iteration, max age)
+_heartbeats: dict[str, tuple[float, float]] = {}
+_backlog: dict[str, Any] = {}
+_backlog_time = 0.0
+ready = False
+
+REASONS = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}
+
+
+def watch(name: str, max_age: float):
+    """
+    Start watching a background loop. The loop is reported stalled if it
+    doesn't beat within max_age seconds from now or from its last beat.
+    """
+    _heartbeats[name] = (time.monotonic(), max_age)
+
+
+def beat(name: str):
+    """Record that a watched background loop completed an iteration."""
+    if name in _heartbeats:
+        _heartbeats[name] = (time.monotonic(), _heartbeats[name][1])
+
+
+def loops() -> dict[str, dict[str, Any]]:
+    now = time.monotonic()
+    return {
+        name: {
+            "age": round(now - last, 3),
+            "max_age": max_age,
+            "stalled": now - last > max_age,
+        }
+        for name, (last, max_age) in _heartbeats.items()
+    }
+
+
+def _load_backlog(script_lengths: dict[str, int]) -> dict[str, Any]:
+    now = time.time()
+    invites, oldest_step = 0, None
+    for tenant, script_length in script_lengths.items():
+        db.current_tenant.set(tenant)
+        count, oldest = db.invite_backlog(script_length)
+        invites += count
+        if oldest and (oldest_step is None or oldest < oldest_step):
+            oldest_step = oldest
+    payments, oldest_payment = db.payment_backlog()
+    return {
+        "pending_invites": invites,
+        "oldest_invite_wait": round(now - oldest_step) if oldest_step else None,
+        "pending_payments": payments,
+        "oldest_payment_age": round(now - oldest_payment) if oldest_payment else None,
+    }
+
+
+async def backlog(script_lengths: dict[str, int]) -> dict[str, Any]:
+    global _backlog, _backlog_time
+    if time.monotonic() - _backlog_time >= BACKLOG_TTL:
+        # runs in a copy of the context, setting the tenant there is local
+        _backlog = await asyncio.wait_for(
+            asyncio.to_thread(_load_backlog, script_lengths), DB_TIMEOUT
+        )
+        _backlog_time = time.monotonic()
+    return _backlog
+
+
+class HealthServer:
+    """
+    Serves /health and /ready on a local port.
+
+    Args:
+        script_lengths: Returns the number of steps in the script of each
+            tenant, used by the invite backlog query.
+        queue_size: Returns the number of queued database writes.
+        lane_stats: Returns Bot API lane latency of each tenant.
+        throttled: Returns the number of dropped updates by kind.
+    """
+
+    def __init__(
+        self,
+        script_lengths: Callable[[], dict[str, int]],
+        queue_size: Callable[[], int],
+        lane_stats: Callable[[], dict[str, Any]],
+        throttled: Callable[[], dict[str, int]],
+    ):
+        self.script_lengths = script_lengths
+        self.queue_size = queue_size
+        self.lane_stats = lane_stats
+        self.throttled = throttled
+        self.server: asyncio.Server | None = None
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f"Health endpoint listening on {host}:{port}")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def report(self) -> dict[str, Any]:
+        report: dict[str, Any] = {
+            "ready": ready,
+            "loops": loops(),
+            "db_pool": db.engine.pool.status(),
+            "write_queue": self.queue_size(),
+            "lanes": self.lane_stats(),
+            "throttled": self.throttled(),
+        }
+        try:
+            report.update(await backlog(self.script_lengths()))
+            report["db"] = "ok"
+        except Exception as e:
+            report["db"] = f"error: {e!r}"
+        return report
+
+    async def liveness(self) -> tuple[int, dict[str, Any]]:
+        report = await self.report()
+        stalled = any(loop["stalled"] for loop in report["loops"].values())
+        return (503 if stalled else 200), report
+
+    async def readiness(self) -> tuple[int, dict[str, Any]]:
+        report = await self.report()
+        try:
+            await asyncio.wait_for(asyncio.to_thread(db.ping), DB_TIMEOUT)
+        except Exception as e:
+            report["db"] = f"error: {e!r}"
+        return (200 if ready and report["db"] == "ok" else 503), report
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            # skip headers, requests have no body
+            while (await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else ""
+            if path == "/health":
+                status, body = await self.liveness()
+            elif path == "/ready":
+                status, body = await self.readiness()
+            else:
+                status, body = 404, {"error": "not found"}
+            payload = json.dumps(body).encode()
+            writer.write(
+                f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode() + payload
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Health request failed: {e!r}")
+        finally:
+            writer.close()
@@ -1,36 +1,241 @@
-from time import sleep
+from time import monotonic, sleep
+import asyncio
+import logging
+import random
 import uuid
+from datetime import datetime, timezone
+from typing import Any, Callable, TypeVar
 from dotenv import load_dotenv
 from os import getenv
 
 load_dotenv()
 
-from yookassa import Configuration, Payment
+logger = logging.getLogger("kassa")
 
-Configuration.account_id = getenv("STORE_ID")
-Configuration.secret_key = getenv("YKASSA_API_KEY")
-bot_link = getenv("BOT_LINK")
+# Seconds a created payment can stay unpaid. YooKassa cancels payments that
+# were not confirmed in time, after that the bot stops polling them.
+PAYMENT_LIFETIME = int(getenv("PAYMENT_LIFETIME", 60 * 60))
 
+CALL_TIMEOUT = 10  # seconds to wait for a single API call
+CALL_ATTEMPTS = 3
+RETRY_DELAY = 0.5  # first retry delay, doubled on each attempt
+RETRY_MAX_DELAY = 8
 
-def create_payment() -> tuple[str, str]:
-    payment = Payment.create(
+T = TypeVar("T")
+
+_payment_api: Any = None
+_permanent_errors: tuple[type[Exception], ...] = ()
+
+
+def payment_api() -> Any:
+    """
+    Get the yookassa Payment class. The SDK is imported and configured on
+    first use, so processes that don't take payments don't pay for the import.
+    """
+    global _payment_api, _permanent_errors
+    if _payment_api is None:
+        from yookassa import Configuration, Payment
+        from yookassa.domain.exceptions import (
+            BadRequestError,
+            ForbiddenError,
+            NotFoundError,
+            UnauthorizedError,
+        )
+
+        Configuration.account_id = getenv("STORE_ID")
+        Configuration.secret_key = getenv("YKASSA_API_KEY")
+        # lets the bot talk to a local stub of the API, see sandbox/kassa_stub.py
+        Configuration.api_url = getenv("KASSA_API_URL", Configuration.api_url)
+        # errors caused by the request itself, retrying won't help and they
+        # don't mean the API is down
+        _permanent_errors = (
+            BadRequestError,
+            ForbiddenError,
+            NotFoundError,
+            UnauthorizedError,
+        )
+        _payment_api = Payment
+    return _payment_api
+
+
+class KassaUnavailable(Exception):
+    """YooKassa did not answer in time or the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calls to the API after several failures in a row. After
+    reset_timeout seconds one trial call is let through: if it succeeds the
+    breaker closes, otherwise it stays open for another reset_timeout.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return (
+            self.opened_at is not None
+            and monotonic() - self.opened_at < self.reset_timeout
+        )
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.is_open:
+            return False
+        # half-open: let this call through, block others until it finishes
+        self.opened_at = monotonic()
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("YooKassa circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning("YooKassa circuit breaker opened")
+            self.opened_at = monotonic()
+
+
+breaker = CircuitBreaker()
+
+
+async def call(fn: Callable[..., T], *args: Any, retry: bool = True) -> T:
+    """
+    Run a blocking YooKassa SDK call in a thread with a timeout, retrying
+    with jittered exponential backoff. Only pass idempotent calls with
+    retry=True (Payment.create is idempotent with a fixed idempotence key).
+
+    Raises:
+        KassaUnavailable: The breaker is open or all attempts failed.
+    """
+    if not breaker.allow():
+        raise KassaUnavailable("circuit breaker is open")
+    attempts = CALL_ATTEMPTS if retry else 1
+    for attempt in range(attempts):
+        try:
+            result = await asyncio.wait_for(asyncio.to_thread(fn, *args), CALL_TIMEOUT)
+            breaker.record_success()
+            return result
+        except Exception as e:
+            if isinstance(e, _permanent_errors):
+                breaker.record_success()  # the API answered
+                raise
+            error = e
+            logger.warning(f"YooKassa call failed, attempt {attempt + 1}: {e!r}")
+            if attempt < attempts - 1:
+                delay = min(RETRY_MAX_DELAY, RETRY_DELAY * 2**attempt)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+    breaker.record_failure()
+    raise KassaUnavailable(repr(error)) from error
+
+
+def payments_available() -> bool:
+    """False while the circuit breaker is open and calls would fail at once."""
+    return not breaker.is_open
+
+
+async def create_payment(amount: str, description: str, return_url: str) -> tuple[str, str]:
+    """
+    Create a payment in rubles.
+
+    Args:
+        amount (str): Price, e.g. "100.00".
+        description (str): Description shown to the buyer.
+        return_url (str): Where the buyer is sent after paying.
+
+    Returns:
+        tuple[str, str]: Payment id and confirmation URL.
+    """
+    # the same key for all attempts, so a retry can't create a second payment
+    idempotence_key = uuid.uuid4()
+    payment = await call(
+        payment_api().create,
         {
-            "amount": {"value": "100.00", "currency": "RUB"},
+            "amount": {"value": amount, "currency": "RUB"},
             "confirmation": {
                 "type": "redirect",
-                "return_url": bot_link,
+                "return_url": return_url,
             },
             "capture": True,
-            "description": "Оплата заказа в StepByStepBot",
+            "description": description,
         },
-        uuid.uuid4(),
+        idempotence_key,
     )
     return payment.id, payment.confirmation.confirmation_url
 
 
-def get_payment_status(payment_id: str) -> str | None:
-    payment = Payment.find_one(payment_id)
+async def get_payment_status(payment_id: str) -> str | None:
+    payment = await call(payment_api().find_one, payment_id)
     if payment is None:
         return None
     else:
         return payment.status
+
+
+async def get_payment_created_time(payment_id: str) -> float | None:
+    payment = await call(payment_api().find_one, payment_id)
+    if payment is None:
+        return None
+    else:
+        created_at = payment.created_at.replace("Z", "+00:00")
+        return datetime.fromisoformat(created_at).timestamp()
+
+
+async def list_payments(
+    created_after: float, status: str | None = None
+) -> list[tuple[str, str]]:
+    """
+    List payments created after the given time, one API call per page of up
+    to 100 payments.
+
+    Args:
+        created_after (float): Unix timestamp, payments created at or after it
+            are listed.
+        status (str | None): List only payments with this status.
+
+    Returns:
+        list[tuple[str, str]]: Payment ids and statuses.
+    """
+    params: dict[str, str | int] = {
+        "created_at.gte": datetime.fromtimestamp(created_after, timezone.utc)
+        .isoformat(timespec="milliseconds")
+        .replace("+00:00", "Z"),
+        "limit": 100,
+    }
+    if status:
+        params["status"] = status
+    payments: list[tuple[str, str]] = []
+    while True:
+        response = await call(payment_api().list, dict(params))
+        payments.extend((payment.id, payment.status) for payment in response.items)
+        if not response.next_cursor:
+            return payments
+        params["cursor"] = response.next_cursor
+
+
+async def reconcile_payments(created_after: float) -> dict[str, str]:
+    """
+    Get final statuses of payments created after the given time with list
+    queries instead of one request per payment.
+
+    Args:
+        created_after (float): Unix timestamp of the oldest payment to check.
+
+    Returns:
+        dict[str, str]: Payment id to status for payments that succeeded or
+        were canceled. Payments that are still pending are not included.
+    """
+    statuses: dict[str, str] = {}
+    for status in ("succeeded", "canceled"):
+        for payment_id, payment_status in await list_payments(created_after, status):
+            statuses[payment_id] = payment_status
+    return statuses
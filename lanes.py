@@ -0,0 +1,116 @@
+"""Priority lanes for outgoing Bot API requests.
+
+All requests of the bot token share one rate limit. Requests made from
+background tasks (invites, payment notifications) go to the bulk lane and
+may use only part of it, the rest stays reserved for interactive replies,
+which are also served first when both lanes are waiting.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import GetUpdates, TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+logger = logging.getLogger("lanes")
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# Lane of requests made by the current task. Tasks get a copy of the context
+# they were created in, so setting it in a background task doesn't affect
+# update handlers.
+current_lane: ContextVar[str] = ContextVar("current_lane", default=INTERACTIVE)
+
+STATS_LOG_INTERVAL = 60
+
+
+class PriorityLimiter:
+    """
+    Spaces requests to at most `rate` per second. Interactive requests
+    book the next free slot right away. Bulk requests take a slot only when
+    it is free now and no more often than `rate * bulk_share` per second,
+    so interactive requests never queue behind a backlog of bulk ones.
+    """
+
+    def __init__(self, rate: float = 30, bulk_share: float = 0.8):
+        self.interval = 1 / rate
+        self.bulk_interval = 1 / (rate * bulk_share)
+        self.next_free = 0.0
+        self.next_bulk = 0.0
+        self.waits: dict[str, deque[float]] = {
+            INTERACTIVE: deque(maxlen=1000),
+            BULK: deque(maxlen=1000),
+        }
+
+    async def acquire(self, lane: str):
+        queued = time.monotonic()
+        if lane == INTERACTIVE:
+            slot = max(queued, self.next_free)
+            self.next_free = slot + self.interval
+            if slot > queued:
+                await asyncio.sleep(slot - queued)
+        else:
+            while True:
+                now = time.monotonic()
+                slot = max(self.next_free, self.next_bulk)
+                if slot <= now:
+                    self.next_free = now + self.interval
+                    self.next_bulk = now + self.bulk_interval
+                    break
+                await asyncio.sleep(slot - now)
+        self.waits[lane].append(time.monotonic() - queued)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """
+        Queue latency of recent requests per lane.
+
+        Returns:
+            dict[str, dict[str, float]]: Lane to number of requests and
+            p50 / p99 / max wait in milliseconds.
+        """
+        result = {}
+        for lane, waits in self.waits.items():
+            ordered = sorted(waits)
+            if not ordered:
+                result[lane] = {"count": 0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+                continue
+            result[lane] = {
+                "count": len(ordered),
+                "p50": ordered[len(ordered) // 2] * 1000,
+                "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+                "max": ordered[-1] * 1000,
+            }
+        return result
+
+
+class LaneMiddleware(BaseRequestMiddleware):
+    """Bot session middleware passing each request through the limiter."""
+
+    def __init__(self, limiter: PriorityLimiter):
+        self.limiter = limiter
+        self.stats_logged = time.monotonic()
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if not isinstance(method, GetUpdates):
+            await self.limiter.acquire(current_lane.get())
+            if time.monotonic() - self.stats_logged > STATS_LOG_INTERVAL:
+                self.stats_logged = time.monotonic()
+                logger.info(f"Queue latency per lane, ms: {self.limiter.stats()}")
+        return await make_request(bot, method)
+
+
+limiter = PriorityLimiter()
@@ -0,0 +1,123 @@
+"""Sending local media files through Telegram file_id cache.
+
+A file given by a local path is uploaded once per bot token. The file_id
+Telegram returns is stored in the MediaFile table under the sha256 of the
+file content and reused for all later sends.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Awaitable, Callable
+
+from aiogram.types import FSInputFile, Message
+from sqlmodel import Session
+
+from database import MediaFile, engine
+
+logger = logging.getLogger("media")
+
+# path -> (mtime_ns, size, sha256), avoids re-hashing unchanged files
+_hashes: dict[str, tuple[int, int, str]] = {}
+# (bot_id, sha256) -> file_id
+_file_ids: dict[tuple[int, str], str] = {}
+_upload_locks: dict[str, asyncio.Lock] = {}
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def file_sha256(path: str) -> str:
+    """
+    Get the sha256 of a local file. Hashes are cached until the file's
+    modification time or size changes.
+    """
+    stat = os.stat(path)
+    cached = _hashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    sha256 = await asyncio.to_thread(_hash_file, path)
+    _hashes[path] = (stat.st_mtime_ns, stat.st_size, sha256)
+    return sha256
+
+
+def get_file_id(bot_id: int, sha256: str) -> str | None:
+    file_id = _file_ids.get((bot_id, sha256))
+    if file_id is None:
+        with Session(engine) as session:
+            media = session.get(MediaFile, (sha256, bot_id))
+            if media:
+                file_id = media.file_id
+                _file_ids[(bot_id, sha256)] = file_id
+    return file_id
+
+
+def save_file_id(bot_id: int, sha256: str, file_id: str):
+    with Session(engine) as session:
+        session.merge(MediaFile(sha256=sha256, bot_id=bot_id, file_id=file_id))
+        session.commit()
+    _file_ids[(bot_id, sha256)] = file_id
+
+
+def message_content(message: Message) -> tuple[str, str] | None:
+    """Get the script content type and file_id of the media in a message."""
+    if message.photo:
+        return "photo", message.photo[-1].file_id
+    for content_type, media in (
+        ("video", message.video),
+        ("video note", message.video_note),
+        ("audio", message.audio),
+        ("voice", message.voice),
+        ("document", message.document),
+        # GIFs sent as documents come back as animations
+        ("document", message.animation),
+    ):
+        if media:
+            return content_type, media.file_id
+    return None
+
+
+def message_file_id(message: Message) -> str | None:
+    """Get file_id of the media attached to a sent message."""
+    content = message_content(message)
+    return content[1] if content else None
+
+
+async def send_local_file(
+    bot_id: int,
+    path: str,
+    send: Callable[[str | FSInputFile], Awaitable[Message]],
+) -> Message:
+    """
+    Send a local file, uploading it only if this bot has no file_id for it yet.
+
+    Args:
+        bot_id (int): Id of the bot sending the file, file_ids are per bot.
+        path (str): Path of the local file.
+        send: Coroutine function that sends the given file_id or input file.
+
+    Returns:
+        Message: The sent message.
+    """
+    sha256 = await file_sha256(path)
+    file_id = get_file_id(bot_id, sha256)
+    if file_id:
+        return await send(file_id)
+    # concurrent first sends of the same file wait for one upload
+    lock = _upload_locks.setdefault(sha256, asyncio.Lock())
+    async with lock:
+        file_id = get_file_id(bot_id, sha256)
+        if file_id:
+            return await send(file_id)
+        message = await send(FSInputFile(path))
+        file_id = message_file_id(message)
+        if file_id:
+            save_file_id(bot_id, sha256, file_id)
+            logger.info(f"Uploaded {path}, cached file_id for {sha256}")
+        return message
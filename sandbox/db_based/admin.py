@@ -51,7 +51,7 @@ def file_upload_dialog(step: db.Step):
 
 
 _mark("db import ready")
-steps = db.get_all_steps()
+steps = db.get_steps_with_files()
 _mark("loaded steps")
 for step in steps:
     step_loop_start = time.perf_counter()
@@ -59,9 +59,7 @@ for step in steps:
         name = st.text_input("Step Name", value=step.name)
         text = st.text_area("Step Text", value=step.step_text)
         with st.container(border=True):
-            files = db.get_files(step.id)
-            _startup_marks.append((f"files for step {step.id}", time.perf_counter()))
-            for file in files:
+            for file in step.files:
                 with st.container(horizontal=True):
                     if st.button(
                         "",
@@ -70,7 +68,7 @@ for step in steps:
                         key=f"delete_file_{file.id}",
                     ):
                         file_delete_confirmation(file)
-                    st.text(f"File: {file.filename}")
+                    st.text(f"File: {file.filename} ({file.size / 1024:.0f} KB)")
             if st.button(
                 "Upload File",
                 type="tertiary",
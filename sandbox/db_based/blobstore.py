@@ -0,0 +1,70 @@
+"""Content-addressed storage for uploaded files.
+
+Files are stored under BLOB_DIR by the sha256 of their content, so identical
+uploads share one file on disk. The database only keeps the hash.
+"""
+
+import hashlib
+import mmap
+import os
+import tempfile
+from typing import BinaryIO, Iterator
+
+BLOB_DIR = "blobs"
+CHUNK_SIZE = 1024 * 1024
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(BLOB_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+def put(stream: BinaryIO) -> tuple[str, int]:
+    """Copy a stream into the store chunk by chunk.
+
+    Returns the sha256 hex digest and size of the content. If a blob with the
+    same content already exists the new copy is discarded.
+    """
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=BLOB_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            while chunk := stream.read(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+                tmp.write(chunk)
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return sha256, size
+
+
+def open_mmap(sha256: str) -> mmap.mmap | bytes:
+    """Map a blob into memory read-only. Empty blobs can't be mapped and are
+    returned as empty bytes."""
+    path = blob_path(sha256)
+    if os.path.getsize(path) == 0:
+        return b""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iter_chunks(sha256: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    with open(blob_path(sha256), "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def delete(sha256: str) -> None:
+    path = blob_path(sha256)
+    if os.path.exists(path):
+        os.remove(path)
@@ -1,10 +1,15 @@
-from typing import Optional
+import io
+import mimetypes
+import mmap
+from typing import Iterator, Optional
 
 from sqlmodel import Field, Session, SQLModel, create_engine, select, Relationship
-from sqlalchemy import BigInteger, asc
-from sqlalchemy.orm import load_only
+from sqlalchemy import BigInteger, asc, func, inspect, text
+from sqlalchemy.orm import joinedload
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
+import blobstore
+
 
 class User(SQLModel, table=True):
     id: int = Field(primary_key=True, sa_type=BigInteger)
@@ -17,7 +22,9 @@ class User(SQLModel, table=True):
 class File(SQLModel, table=True):
     id: int = Field(default=None, primary_key=True)
     filename: str
-    data: bytes
+    sha256: str = Field(index=True)
+    size: int = Field(default=0)
+    mime: str = Field(default="application/octet-stream")
     step_id: int = Field(foreign_key="step.id", default=None)
     step: "Step" = Relationship(back_populates="files")
 
@@ -37,6 +44,89 @@ engine = create_engine(db_url)
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    migrate_file_blobs()
+
+
+def migrate_file_blobs() -> None:
+    """Move `data` blobs of a file table created by older versions into the
+    blob store and rebuild the table with the current columns.
+
+    The rename, copy and drop run in one transaction, so a failed copy leaves
+    the old table as it was and the migration runs again on the next start.
+    Blobs stored before the failure are reused then.
+    """
+    columns = [c["name"] for c in inspect(engine).get_columns("file")]
+    if "data" not in columns:
+        return
+    with engine.begin() as conn:
+        # pysqlite runs DDL outside of transactions unless BEGIN is explicit
+        conn.exec_driver_sql("BEGIN")
+        conn.execute(text("ALTER TABLE file RENAME TO file_legacy"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_file_sha256"))
+        File.__table__.create(conn)  # type: ignore
+        rows = conn.execute(
+            text("SELECT id, filename, data, step_id FROM file_legacy")
+        )
+        for file_id, filename, data, step_id in rows:
+            sha256, size = blobstore.put(io.BytesIO(data))
+            conn.execute(
+                File.__table__.insert().values(  # type: ignore
+                    id=file_id,
+                    filename=filename,
+                    sha256=sha256,
+                    size=size,
+                    mime=_guess_mime(filename),
+                    step_id=step_id,
+                )
+            )
+        conn.execute(text("DROP TABLE file_legacy"))
+
+
+def _guess_mime(filename: str) -> str:
+    mime, _ = mimetypes.guess_type(filename)
+    return mime or "application/octet-stream"
+
+
+def _store_upload(file: UploadedFile, step_id: Optional[int] = None) -> File:
+    """Stream an upload into the blob store and build its File record."""
+    file.seek(0)
+    sha256, size = blobstore.put(file)
+    return File(
+        filename=file.name,
+        sha256=sha256,
+        size=size,
+        mime=file.type or _guess_mime(file.name),
+        step_id=step_id,  # type: ignore
+    )
+
+
+# steps with file metadata, shared between Streamlit reruns and sessions.
+# Reset by every function that changes steps or files.
+_steps_cache: Optional[list[Step]] = None
+
+
+def invalidate_steps_cache() -> None:
+    global _steps_cache
+    _steps_cache = None
+
+
+def get_steps_with_files() -> list[Step]:
+    """Return all steps ordered by `order` with their `files` loaded.
+
+    Steps and file metadata come from a single joined query. The result is
+    cached until a step or file changes, so treat the returned objects as
+    read-only.
+    """
+    global _steps_cache
+    if _steps_cache is None:
+        with Session(engine) as session:
+            steps = session.exec(
+                select(Step)
+                .options(joinedload(Step.files))  # type: ignore
+                .order_by(Step.order)  # type: ignore
+            ).unique()
+            _steps_cache = list(steps)
+    return _steps_cache
 
 
 def get_all_steps() -> list[Step]:
@@ -53,55 +143,63 @@ def update_step(step_id: int, name: str, text: str) -> None:
             step.step_text = text
             session.add(step)
             session.commit()
+    invalidate_steps_cache()
 
 
 def get_files(step_id: int) -> list[File]:
     with Session(engine) as session:
-        # load only metadata (id, filename, step_id) to avoid loading large
-        # `data` blobs into memory when listing files.
-        files = session.exec(
-            select(File)
-            .options(load_only(File.id, File.filename, File.step_id))
-            .where(File.step_id == step_id)
-        ).all()
+        files = session.exec(select(File).where(File.step_id == step_id)).all()
         return list(files)
 
 
-def get_file_data(file_id: int) -> Optional[bytes]:
-    """Return raw file bytes for a single file. This loads the `data` column.
+def open_file_data(file_id: int) -> Optional[mmap.mmap | bytes]:
+    """Return file content as a read-only memory map of its blob.
 
-    Use this only when the user requests the file (download/view), not when
-    listing files.
+    Pages are loaded by the OS on access, so large files are not read into
+    memory up front. Use iter_file_data to stream the content instead.
     """
     with Session(engine) as session:
         file = session.get(File, file_id)
         if file:
-            return file.data
+            return blobstore.open_mmap(file.sha256)
         return None
 
 
+def iter_file_data(file_id: int) -> Iterator[bytes]:
+    with Session(engine) as session:
+        file = session.get(File, file_id)
+        sha256 = file.sha256 if file else None
+    if sha256:
+        yield from blobstore.iter_chunks(sha256)
+
+
 def add_files(step_id: int, files: list[UploadedFile]) -> None:
     with Session(engine) as session:
         step = session.get(Step, step_id)
         if step:
             for file in files:
-                file_data = file.read()
-                file_record = File(
-                    filename=file.name,
-                    data=file_data,
-                    step_id=step_id,
-                )
+                file_record = _store_upload(file, step_id)
                 session.add(file_record)
                 step.files.append(file_record)
             session.commit()
+    invalidate_steps_cache()
 
 
 def delete_file(file_id: int) -> None:
     with Session(engine) as session:
         file = session.get(File, file_id)
         if file:
+            sha256 = file.sha256
             session.delete(file)
             session.commit()
+            # blobs are shared between identical uploads, keep it while
+            # another file record still points to it
+            in_use = session.exec(
+                select(func.count()).where(File.sha256 == sha256)
+            ).one()
+            if not in_use:
+                blobstore.delete(sha256)
+    invalidate_steps_cache()
 
 
 def add_step(
@@ -114,11 +212,8 @@ def add_step(
         step = Step(order=order, name=name, step_text=text)
         session.add(step)
         for file in files:
-            file_data = file.read()
-            file_record = File(
-                filename=file.name,
-                data=file_data,
-            )
+            file_record = _store_upload(file)
             session.add(file_record)
             step.files.append(file_record)
         session.commit()
+    invalidate_steps_cache()
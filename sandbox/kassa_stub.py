@@ -0,0 +1,126 @@
+# Local stub of the YooKassa payments API for trying out kassa.py.
+# Start it from the repository root: python sandbox/kassa_stub.py
+# and point the bot to it with KASSA_API_URL=http://127.0.0.1:8800/v3
+# With --demo it fills the stub with random payments, runs
+# kassa.reconcile_payments against it and prints the number of API calls.
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PORT = 8800
+payments: dict[str, dict] = {}
+requests_count = 0
+
+
+def iso(ts: float) -> str:
+    return (
+        datetime.fromtimestamp(ts, timezone.utc)
+        .isoformat(timespec="milliseconds")
+        .replace("+00:00", "Z")
+    )
+
+
+def add_payment(status: str = "pending", created: float | None = None) -> dict:
+    payment = {
+        "id": str(uuid.uuid4()),
+        "status": status,
+        "paid": status == "succeeded",
+        "amount": {"value": "100.00", "currency": "RUB"},
+        "created_at": iso(created or time.time()),
+        "confirmation": {
+            "type": "redirect",
+            "confirmation_url": "https://example.com/pay",
+        },
+        "test": True,
+        "refundable": False,
+    }
+    payments[payment["id"]] = payment
+    return payment
+
+
+class Handler(BaseHTTPRequestHandler):
+    def send_json(self, data: dict, code: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        global requests_count
+        requests_count += 1
+        url = urlparse(self.path)
+        if url.path.startswith("/v3/payments/"):
+            payment = payments.get(url.path.rsplit("/", 1)[-1])
+            if payment:
+                self.send_json(payment)
+            else:
+                self.send_json({"type": "error", "code": "not_found"}, 404)
+            return
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        # newest first, as the real API does
+        items = sorted(payments.values(), key=lambda p: p["created_at"], reverse=True)
+        if "created_at.gte" in query:
+            items = [p for p in items if p["created_at"] >= query["created_at.gte"]]
+        if "status" in query:
+            items = [p for p in items if p["status"] == query["status"]]
+        offset = int(query.get("cursor", 0))
+        limit = int(query.get("limit", 10))
+        page = items[offset : offset + limit]
+        response: dict = {"type": "list", "items": page}
+        if offset + limit < len(items):
+            response["next_cursor"] = str(offset + limit)
+        self.send_json(response)
+
+    def do_POST(self):
+        global requests_count
+        requests_count += 1
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_json(add_payment())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server() -> ThreadingHTTPServer:
+    return ThreadingHTTPServer(("127.0.0.1", PORT), Handler)
+
+
+def serve() -> ThreadingHTTPServer:
+    """Start the stub in a background thread."""
+    server = make_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    if "--demo" not in sys.argv:
+        print(f"Serving YooKassa stub on http://127.0.0.1:{PORT}/v3")
+        make_server().serve_forever()
+    else:
+        os.environ["KASSA_API_URL"] = f"http://127.0.0.1:{PORT}/v3"
+        os.environ.setdefault("STORE_ID", "stub")
+        os.environ.setdefault("YKASSA_API_KEY", "stub")
+        sys.path.insert(0, os.getcwd())
+        import kassa
+
+        serve()
+        start = time.time() - 3600
+        for _ in range(5000):
+            add_payment(
+                random.choice(["pending", "succeeded", "canceled"]),
+                start + random.random() * 3600,
+            )
+        statuses = asyncio.run(kassa.reconcile_payments(start))
+        expected = sum(p["status"] != "pending" for p in payments.values())
+        print(f"{len(payments)} payments, {len(statuses)} final statuses "
+              f"(expected {expected}), {requests_count} API calls")
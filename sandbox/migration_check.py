@@ -0,0 +1,96 @@
+# Check that create_db_and_tables upgrades a SQLite database created by the
+# first version of the bot without losing users, and that a migration that
+# fails halfway leaves the database unchanged.
+# Run from the repository root: python sandbox/migration_check.py
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.getcwd())
+check_dir = tempfile.mkdtemp()
+os.environ.setdefault("DB_URL", f"sqlite:///{check_dir}/unused.db")
+
+from sqlalchemy import create_engine, inspect, text
+from sqlmodel import Session
+
+import database as db
+
+# schema and rows of the user table as the first version created them
+BASELINE = [
+    """CREATE TABLE user (
+        id BIGINT NOT NULL,
+        current_step INTEGER NOT NULL,
+        payment_status VARCHAR NOT NULL,
+        payment_key VARCHAR NOT NULL,
+        payed BOOLEAN NOT NULL,
+        step_sent_time FLOAT NOT NULL,
+        next_step_invite_sent BOOLEAN NOT NULL,
+        upload_mode BOOLEAN NOT NULL,
+        is_admin BOOLEAN NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    "INSERT INTO user VALUES (5, 2, 'succeeded', 'key5', 1, 1700000000.0, 0, 0, 0)",
+    "INSERT INTO user VALUES (6, 0, '', '', 0, 0.0, 0, 0, 1)",
+]
+
+
+def baseline_engine(name: str):
+    engine = create_engine(f"sqlite:///{check_dir}/{name}.db")
+    with engine.begin() as conn:
+        for statement in BASELINE:
+            conn.execute(text(statement))
+    db.engine = engine
+    return engine
+
+
+def check_upgrade():
+    engine = baseline_engine("upgrade")
+    assert db.create_db_and_tables()
+    columns = {column["name"] for column in inspect(engine).get_columns("user")}
+    assert columns == set(db.UserBase.model_fields), columns
+    with Session(engine) as session:
+        user = db.get_user(session, 5)
+        assert user and user.current_step == 2 and user.payed and user.payment_key == "key5"
+        admin = db.get_user(session, 6)
+        assert admin and admin.is_admin and admin.utc_offset == db.DEFAULT_UTC_OFFSET
+    assert not db.create_db_and_tables()
+    print("upgrade: users kept")
+
+
+def check_tenant_copy():
+    # the rebuild fills columns the old table doesn't have with defaults
+    engine = baseline_engine("copy")
+    db.migrate_tenant_columns()
+    with Session(engine) as session:
+        user = db.get_user(session, 5)
+        assert user and user.tenant == "" and user.delivered_items == 0
+    assert not inspect(engine).has_table("user_legacy")
+    print("tenant copy: missing columns filled with defaults")
+
+
+def check_failed_migration():
+    engine = baseline_engine("failed")
+    insert = db.insert
+
+    def failing_insert(*args, **kwargs):
+        raise RuntimeError("copy failed")
+
+    db.insert = failing_insert
+    try:
+        db.migrate_tenant_columns()
+        raise AssertionError("migration did not fail")
+    except RuntimeError:
+        pass
+    finally:
+        db.insert = insert
+    inspector = inspect(engine)
+    assert not inspector.has_table("user_legacy")
+    assert "tenant" not in {column["name"] for column in inspector.get_columns("user")}
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT count(*) FROM user")).scalar() == 2
+    print("failed migration: database unchanged")
+
+
+check_upgrade()
+check_tenant_copy()
+check_failed_migration()
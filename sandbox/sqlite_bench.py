@@ -0,0 +1,61 @@
+# Compare commit throughput of per-user updates on SQLite:
+# default settings, SQLite profile from database.py, and the profile with
+# writes going through WriteQueue.
+# Run from the repository root: python sandbox/sqlite_bench.py
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.getcwd())
+bench_dir = tempfile.mkdtemp()
+os.environ.setdefault("DB_URL", f"sqlite:///{bench_dir}/unused.db")
+
+from sqlmodel import Session, SQLModel, create_engine
+
+from database import User, apply_sqlite_profile, set_users
+from writer import WriteQueue
+
+USERS = 2000
+
+
+def make_engine(name: str, profile: bool):
+    engine = create_engine(f"sqlite:///{bench_dir}/{name}.db")
+    if profile:
+        apply_sqlite_profile(engine)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(User(id=i) for i in range(USERS))
+        session.commit()
+    return engine
+
+
+def per_row_commits(engine) -> float:
+    start = time.perf_counter()
+    for i in range(USERS):
+        with Session(engine) as session:
+            set_users(session, [i], next_step_invite_sent=True)
+            session.commit()
+    return time.perf_counter() - start
+
+
+async def queued_commits(engine) -> float:
+    writer = WriteQueue(engine)
+    writer.start()
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(writer.submit(set_users, [i], next_step_invite_sent=True) for i in range(USERS))
+    )
+    elapsed = time.perf_counter() - start
+    await writer.stop()
+    return elapsed
+
+
+results = {
+    "default, commit per update": per_row_commits(make_engine("default", False)),
+    "profile, commit per update": per_row_commits(make_engine("profile", True)),
+    "profile, WriteQueue": asyncio.run(queued_commits(make_engine("queue", True))),
+}
+for name, elapsed in results.items():
+    print(f"{name:30} {USERS / elapsed:10.0f} updates/s")
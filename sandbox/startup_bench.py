@@ -0,0 +1,51 @@
+# Measure bot startup: import time of bot.py and its heavy dependencies and
+# the time to initialize the database, each in a fresh interpreter.
+# Run from the repository root with .env set up: python sandbox/startup_bench.py
+# Time to first update is logged by the bot itself, the latest value from
+# bot.log is printed at the end.
+import re
+import subprocess
+import sys
+
+RUNS = 5
+
+MEASURE = """
+import time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+{after}
+done = time.perf_counter()
+print((imported - start) * 1000, (done - imported) * 1000)
+"""
+
+cases = {
+    "kassa": ("kassa", ""),
+    "yookassa": ("yookassa", ""),
+    "database": ("database", ""),
+    "bot + create_db_and_tables": ("bot", "bot.create_db_and_tables()"),
+}
+
+for name, (module, after) in cases.items():
+    imports, inits = [], []
+    for _ in range(RUNS):
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE.format(module=module, after=after)],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        imports.append(float(output[0]))
+        inits.append(float(output[1]))
+    line = f"{name:30} import {min(imports):7.1f} ms"
+    if after:
+        line += f", init {min(inits):6.1f} ms"
+    print(line)
+
+try:
+    with open("bot.log", encoding="utf-8") as log:
+        found = re.findall(r"First update received (\d+) ms", log.read())
+    if found:
+        print(f"{'time to first update':30} {found[-1]} ms (last run in bot.log)")
+except FileNotFoundError:
+    pass
@@ -0,0 +1,64 @@
+# Measure users_io export and import throughput on SQLite: export USERS
+# users to JSONL and CSV, import each file into an empty database and again
+# over the imported rows (all upserts hit existing users). With "memory"
+# as the second argument it reports peak Python heap use instead, which
+# should stay flat as USERS grows; tracing makes the run several times slower.
+# Run from the repository root: python sandbox/users_io_bench.py [USERS] [memory]
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.getcwd())
+bench_dir = tempfile.mkdtemp()
+os.environ.setdefault("DB_URL", f"sqlite:///{bench_dir}/unused.db")
+
+from sqlalchemy import insert
+from sqlmodel import SQLModel, create_engine
+
+from database import User, apply_sqlite_profile
+from users_io import export_users, import_users
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+MEMORY = sys.argv[2:] == ["memory"]
+
+
+def make_engine(name: str):
+    engine = create_engine(f"sqlite:///{bench_dir}/{name}.db")
+    apply_sqlite_profile(engine)
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+
+def measure(name: str, fn, *args):
+    if MEMORY:
+        tracemalloc.start()
+        fn(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name:24} {peak / 2**20:8.1f} MiB peak")
+    else:
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        print(f"{name:24} {USERS / elapsed * 60:12,.0f} rows/min")
+
+
+source = make_engine("source")
+with source.begin() as conn:
+    for first in range(0, USERS, 10_000):
+        conn.execute(
+            insert(User.__table__),
+            [
+                {"tenant": "", "id": i, "current_step": i % 20, "payment_key": f"key{i}"}
+                for i in range(first, min(first + 10_000, USERS))
+            ],
+        )
+
+for ext in ("jsonl", "csv"):
+    path = f"{bench_dir}/users.{ext}"
+    target = make_engine(f"target_{ext}")
+    measure(f"export {ext}", export_users, path, "", source)
+    measure(f"import {ext}, new rows", import_users, path, "", target)
+    measure(f"import {ext}, upserts", import_users, path, "", target)
@@ -0,0 +1,40 @@
+"""Bots served by one process.
+
+Besides the default bot of BOT_KEY, the TENANTS environment variable may
+list more bots as comma separated name=token pairs. Each tenant has its own
+settings.json in tenants/<name>/, its own script and users in the shared
+database, told apart by the tenant column. The default tenant has the empty
+name and keeps its files in the working directory. All tenants take
+payments through the one YooKassa shop of STORE_ID, the price and the link
+buyers return to come from the payment settings of each tenant.
+"""
+
+import os
+from os import getenv
+
+
+def tenant_keys() -> dict[str, str]:
+    """
+    Get bot tokens of all tenants.
+
+    Returns:
+        dict[str, str]: Tenant name to bot token, the default tenant first.
+    """
+    keys: dict[str, str] = {}
+    bot_key = getenv("BOT_KEY")
+    if bot_key:
+        keys[""] = bot_key
+    for entry in getenv("TENANTS", "").split(","):
+        if not entry.strip():
+            continue
+        name, _, key = entry.partition("=")
+        name = name.strip()
+        if not name or not key.strip() or os.sep in name or name.startswith("."):
+            raise ValueError(f"Invalid TENANTS entry {entry!r}, expected name=token")
+        keys[name] = key.strip()
+    return keys
+
+
+def tenant_directory(name: str) -> str:
+    """Get the directory with settings.json and script.json of a tenant."""
+    return os.path.join("tenants", name) if name else "."
@@ -0,0 +1,109 @@
+"""Per-user throttling of incoming updates."""
+
+import logging
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, User
+
+logger = logging.getLogger("throttling")
+
+# Cost of updates that do more work than a plain message: /start may create
+# a payment, /reset and the next step button write to the database.
+COSTS: dict[str, float] = {
+    "/start": 5,
+    "/reset": 3,
+    "get_step": 3,
+}
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "throttled", "media_group")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.throttled = False
+        self.media_group: str | None = None
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Outer update middleware with a token bucket per user. Each user gets
+    `burst` tokens refilled at `rate` tokens per second, an update costs
+    COSTS of its command or callback data or 1. An album is charged once,
+    for its first message. Updates that don't fit are dropped before they
+    reach the handlers, dropped callback queries are answered so the client
+    stops waiting. Buckets of the least recently seen users are evicted
+    above `max_users`, `throttled` counts dropped updates by kind.
+    """
+
+    def __init__(self, rate: float = 0.5, burst: float = 10, max_users: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        # keyed by (bot id, user id), users of different bots are separate
+        self.buckets: OrderedDict[tuple[int, int], TokenBucket] = OrderedDict()
+        self.throttled: Counter[str] = Counter()
+
+    @staticmethod
+    def update_kind(update: Update) -> str:
+        if update.message and update.message.text:
+            text = update.message.text
+            if text.startswith("/"):
+                return text.split()[0].split("@")[0]
+            return "message"
+        if update.callback_query:
+            return update.callback_query.data or "callback"
+        return update.event_type
+
+    def allow(
+        self, key: tuple[int, int], cost: float, media_group: str | None = None
+    ) -> bool:
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_users:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.tokens = min(
+                self.burst, bucket.tokens + (now - bucket.updated) * self.rate
+            )
+            bucket.updated = now
+        if media_group is not None and media_group == bucket.media_group:
+            return True
+        if bucket.tokens < cost:
+            if not bucket.throttled:
+                logger.info(f"Throttling user {key[1]} of bot {key[0]}")
+            bucket.throttled = True
+            return False
+        bucket.tokens -= cost
+        bucket.throttled = False
+        if media_group is not None:
+            bucket.media_group = media_group
+        return True
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is not None and isinstance(event, Update):
+            kind = self.update_kind(event)
+            media_group = event.message.media_group_id if event.message else None
+            if not self.allow((data["bot"].id, user.id), COSTS.get(kind, 1), media_group):
+                self.throttled[kind] += 1
+                if event.callback_query:
+                    try:
+                        await data["bot"].answer_callback_query(event.callback_query.id)
+                    except Exception as e:
+                        logger.warning(f"Failed to answer throttled callback: {e!r}")
+                return None
+        return await handler(event, data)
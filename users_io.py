@@ -0,0 +1,174 @@
+"""Bulk export and import of users.
+
+Moves users of one tenant between databases, e.g. to restore a backup or to
+copy users to a staging environment:
+
+    python users_io.py export users.jsonl [--tenant NAME]
+    python users_io.py import users.jsonl [--tenant NAME]
+
+Files ending in .csv are written and read as CSV with a header row, other
+files as JSON lines. Export streams rows through a server-side cursor and
+import upserts them in chunks with INSERT ... ON CONFLICT, so memory use
+doesn't grow with the number of users. Archived users are exported along
+with active ones and imported as active, the archive job moves them back.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import time
+from itertools import islice
+from typing import Any, Iterable, Iterator
+
+from sqlalchemy import Engine, delete, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+import database as db
+
+logger = logging.getLogger("users_io")
+
+CHUNK_SIZE = 2000
+
+# columns of exported rows, the tenant is given on import instead
+COLUMNS = [name for name in db.UserBase.model_fields if name != "tenant"]
+TYPES = {name: db.UserBase.model_fields[name].annotation for name in COLUMNS}
+
+
+def _is_csv(path: str) -> bool:
+    return path.lower().endswith(".csv")
+
+
+def _parse(name: str, value: str) -> Any:
+    """Convert a CSV field to the type of its column."""
+    if TYPES[name] is bool:
+        return value.lower() in ("1", "true")
+    return TYPES[name](value)
+
+
+def _read_rows(path: str) -> Iterator[dict[str, Any]]:
+    with open(path, newline="", encoding="utf-8") as file:
+        if _is_csv(path):
+            for record in csv.DictReader(file):
+                yield {
+                    name: _parse(name, value)
+                    for name, value in record.items()
+                    if name in TYPES and value != ""
+                }
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _upsert_statement(engine: Engine) -> Any:
+    table = db.User.__table__
+    dialect = engine.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        module = sqlite if dialect == "sqlite" else postgresql
+        stmt = module.insert(table)
+        return stmt.on_conflict_do_update(
+            index_elements=[table.c.tenant, table.c.id],
+            set_={name: stmt.excluded[name] for name in COLUMNS if name != "id"},
+        )
+    if dialect in ("mysql", "mariadb"):
+        stmt = mysql.insert(table)
+        return stmt.on_duplicate_key_update(
+            {name: stmt.inserted[name] for name in COLUMNS if name != "id"}
+        )
+    raise ValueError(f"Bulk import is not supported for {dialect} databases")
+
+
+def export_users(
+    path: str, tenant: str = "", engine: Engine | None = None, chunk_size: int = CHUNK_SIZE
+) -> int:
+    """
+    Write users of a tenant to a JSONL or CSV file.
+
+    Returns:
+        int: Number of exported users.
+    """
+    engine = engine or db.engine
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as file, engine.connect() as conn:
+        if _is_csv(path):
+            writer = csv.writer(file)
+            writer.writerow(COLUMNS)
+            write = writer.writerow
+        else:
+            write = lambda row: file.write(json.dumps(dict(zip(COLUMNS, row))) + "\n")
+        # yield_per fetches rows in batches through a server-side cursor
+        conn = conn.execution_options(yield_per=chunk_size)
+        for table in (db.User.__table__, db.ArchivedUser.__table__):
+            rows = conn.execute(
+                select(*[table.c[name] for name in COLUMNS])
+                .where(table.c.tenant == tenant)
+                .order_by(table.c.id)
+            )
+            for row in rows:
+                write(row)
+                count += 1
+    return count
+
+
+def _chunks(rows: Iterable[dict[str, Any]], size: int) -> Iterator[list[dict[str, Any]]]:
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def import_users(
+    path: str, tenant: str = "", engine: Engine | None = None, chunk_size: int = CHUNK_SIZE
+) -> int:
+    """
+    Insert or update users of a tenant from a JSONL or CSV file. Missing
+    columns get their defaults, archived copies of imported users are
+    deleted.
+
+    Returns:
+        int: Number of imported users.
+    """
+    engine = engine or db.engine
+    stmt = _upsert_statement(engine)
+    defaults = {
+        name: db.UserBase.model_fields[name].get_default(call_default_factory=True)
+        for name in COLUMNS
+    }
+    archived = db.ArchivedUser.__table__
+    count = 0
+    for chunk in _chunks(_read_rows(path), chunk_size):
+        values = [
+            {**defaults, **{k: v for k, v in row.items() if k in defaults}, "tenant": tenant}
+            for row in chunk
+        ]
+        ids = [row["id"] for row in values]
+        with engine.begin() as conn:
+            conn.execute(stmt, values)
+            conn.execute(
+                delete(archived).where(archived.c.tenant == tenant, archived.c.id.in_(ids))
+            )
+        count += len(values)
+        logger.info(f"Imported {count} users")
+    return count
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export or import users of a tenant")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="JSONL file, or CSV if the name ends in .csv")
+    parser.add_argument("--tenant", default="", help="tenant name, the default bot if omitted")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    db.create_db_and_tables()
+    start = time.perf_counter()
+    if args.command == "export":
+        count = export_users(args.path, args.tenant, chunk_size=args.chunk_size)
+    else:
+        count = import_users(args.path, args.tenant, chunk_size=args.chunk_size)
+    logger.info(f"{args.command.capitalize()}ed {count} users in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
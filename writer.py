@@ -0,0 +1,104 @@
+"""Single writer for database updates made by the bot's background tasks."""
+
+import asyncio
+import contextvars
+import functools
+import logging
+from typing import Any, Callable, TypeVar
+
+from sqlalchemy import Engine
+from sqlmodel import Session
+
+logger = logging.getLogger("writer")
+
+T = TypeVar("T")
+
+
+class WriteQueue:
+    """
+    Queue of write operations executed one batch at a time.
+
+    Operations are functions taking a Session as the first argument. All
+    operations queued while the previous batch was running are executed in
+    one transaction with a single commit, which keeps the number of commits
+    (and lock acquisitions) low when many small updates arrive at once.
+    If the batch fails, its operations are retried one by one so only the
+    failing operation reports an error.
+
+    The worker runs in the event loop thread, as the bot's handlers do, so
+    all writes of the process happen one after another.
+    """
+
+    def __init__(self, engine: Engine, max_batch: int = 200):
+        self.engine = engine
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Wait for queued operations to finish and stop the worker."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        self._task = None
+
+    def size(self) -> int:
+        """Number of operations waiting to be committed."""
+        return self._queue.qsize()
+
+    async def submit(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Queue an operation and wait until it is committed.
+
+        Without a running worker the operation is executed right away. The
+        operation sees the context variables of the caller, like the
+        current tenant.
+
+        Returns:
+            The value returned by the operation.
+        """
+        if self._task is None:
+            with Session(self.engine) as session:
+                result = fn(session, *args, **kwargs)
+                session.commit()
+                return result
+        future = asyncio.get_running_loop().create_future()
+        fn = functools.partial(contextvars.copy_context().run, fn)
+        await self._queue.put((fn, args, kwargs, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                self._execute(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _execute(self, batch: list):
+        try:
+            with Session(self.engine) as session:
+                results = [
+                    fn(session, *args, **kwargs) for fn, args, kwargs, _ in batch
+                ]
+                session.commit()
+        except Exception as e:
+            if len(batch) > 1:
+                logger.warning(f"Batch of {len(batch)} writes failed, retrying one by one: {e}")
+                for item in batch:
+                    self._execute([item])
+            else:
+                future = batch[0][3]
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)